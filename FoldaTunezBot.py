@@ -11,23 +11,119 @@ Version 0.5.1
 """
 
 import asyncio
+import atexit
+import bisect
+import difflib
+import hashlib
+import importlib
+import io
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import random
+import re
+import sqlite3
+import struct
+import subprocess
 import sys
+import threading
 import time
 import traceback
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+import unicodedata
+import urllib.request
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 from dataclasses import dataclass, field
 from logging.handlers import RotatingFileHandler
-from typing import Optional, Dict, List, Any, Union
+from queue import Empty, Full, Queue
+from typing import Optional, Dict, List, Any, Tuple, Union, Callable
 
+_STARTED = time.perf_counter()
 import discord
 from discord.ext import commands
-import yt_dlp as youtube_dl
 from discord.ui import View, Button
 
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process download locks
+    fcntl = None
+
+
+# ==================== Startup Timing ====================
+class StartupTimer:
+    """Start-up breakdown: sequential phases plus background jobs timed on their own."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self._last = started
+        self.phases: List[Tuple[str, float]] = []
+        self.background: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        """Close the phase that ran since the previous mark."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def timed(self, job: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.background[job] = time.perf_counter() - start
+
+    def report(self) -> str:
+        lines = [f"{phase:<24}{seconds * 1000:>9.1f} ms" for phase, seconds in self.phases]
+        lines.append(f"{'total':<24}{(self._last - self.started) * 1000:>9.1f} ms")
+        if self.background:
+            lines.append("background:")
+            lines += [f"  {job:<22}{seconds * 1000:>9.1f} ms" for job, seconds in self.background.items()]
+        return "\n".join(lines)
+
+
+startup = StartupTimer(_STARTED)
+startup.mark('import discord')
+
+
+class _LazyModule:
+    """Module proxy that imports on first attribute access.
+
+    yt-dlp takes a good share of start-up time to import and nothing needs it
+    until the first download or URL lookup; a background task imports it
+    right after login so that first lookup rarely pays for it.
+    """
+
+    def __init__(self, name: str):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                module = self._module
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr: str, value) -> None:
+        setattr(self.load(), attr, value)
+
+
+youtube_dl = _LazyModule('yt_dlp')
+
 # ==================== Configuration ====================
 from dotenv import load_dotenv
 load_dotenv()
@@ -38,59 +134,1356 @@ if not TOKEN:
 
 BOT_PREFIX = "!"
 FFMPEG_PATH = os.getenv('FFMPEG_PATH', "ffmpeg")
+FFPROBE_PATH = os.getenv('FFPROBE_PATH', "ffprobe")
 MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '5'))
 DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', '300'))
+DOWNLOAD_BACKEND = os.getenv('DOWNLOAD_BACKEND', 'thread').lower()  # 'thread' or 'process'
+OPUS_BITRATE = int(os.getenv('OPUS_BITRATE', '128'))
+AUDIO_STORAGE = os.getenv('AUDIO_STORAGE', 'mp3').lower()  # 'mp3' (transcode) or 'native' (keep source stream)
 VOICE_TIMEOUT = int(os.getenv('VOICE_TIMEOUT', '60'))
 MAX_PLAYLIST_ITEMS = int(os.getenv('MAX_PLAYLIST_ITEMS', '200'))
-
-SUPPORTED_AUDIO_EXTENSIONS = {'.mp3', '.m4a', '.mp4', '.wav', '.flac', '.ogg', '.aac', '.webm'}
+PROGRESSIVE_PLAYBACK = os.getenv('PROGRESSIVE_PLAYBACK', '0').lower() in ('1', 'true', 'yes')
+PROGRESSIVE_MIN_BYTES = int(os.getenv('PROGRESSIVE_MIN_BYTES', str(256 * 1024)))
+PREFETCH_WINDOW = int(os.getenv('PREFETCH_WINDOW', '3'))
+TRACK_CACHE_DIR = os.getenv('TRACK_CACHE_DIR', 'downloads')
+TRACK_CACHE_MAX_MB = int(os.getenv('TRACK_CACHE_MAX_MB', '5120'))
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+MESSAGE_COALESCE_WINDOW = float(os.getenv('MESSAGE_COALESCE_WINDOW', '1.5'))
+FRAME_CACHE_MAX_MB = int(os.getenv('FRAME_CACHE_MAX_MB', '1024'))  # 0 disables the Opus frame cache
+METADATA_HOT_ENTRIES = int(os.getenv('METADATA_HOT_ENTRIES', '1024'))
+METADATA_TTL_SEARCH = int(os.getenv('METADATA_TTL_SEARCH', '21600'))
+METADATA_TTL_PLAYLIST = int(os.getenv('METADATA_TTL_PLAYLIST', '3600'))
+# Resolved video info carries signed stream URLs that expire after a few hours
+METADATA_TTL_VIDEO = int(os.getenv('METADATA_TTL_VIDEO', '3600'))
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'file').lower()  # 'file', 'otlp' or 'off'
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SAMPLES = int(os.getenv('TRACE_SAMPLES', '1000'))  # recent durations kept per stage for percentiles
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # 0 disables the Prometheus endpoint
+PERSIST_QUEUES = os.getenv('PERSIST_QUEUES', '1').lower() in ('1', 'true', 'yes')
+QUEUE_STATE_DIR = os.getenv('QUEUE_STATE_DIR', os.path.join(CACHE_DIR, 'queues'))
+# Local music library: directories to index, separated by os.pathsep; empty disables it
+LIBRARY_DIRS = [path for path in os.getenv('LIBRARY_DIRS', '').split(os.pathsep) if path]
+LIBRARY_RESCAN_INTERVAL = int(os.getenv('LIBRARY_RESCAN_INTERVAL', '3600'))  # 0 scans once at startup
+LIBRARY_SCAN_WORKERS = int(os.getenv('LIBRARY_SCAN_WORKERS', '4'))  # concurrent ffprobe runs
+# Played tracks kept per guild; uncapped while the queue is looping, since looping replays them
+HISTORY_SIZE = int(os.getenv('HISTORY_SIZE', '500'))
+IDLE_DISCONNECT = int(os.getenv('IDLE_DISCONNECT', '600'))  # seconds before an idle voice client leaves; 0 never
+GUILD_STATE_TTL = int(os.getenv('GUILD_STATE_TTL', '1800'))  # seconds before an idle guild is dropped from memory
+REAPER_INTERVAL = int(os.getenv('REAPER_INTERVAL', '60'))
+# SHARD_COUNT=0 runs one unsharded process; a number or 'auto' starts a supervisor
+# that runs SHARDS_PER_PROCESS shards in each child process
+SHARD_COUNT = os.getenv('SHARD_COUNT', '0').lower()
+SHARDS_PER_PROCESS = int(os.getenv('SHARDS_PER_PROCESS', '1'))
+# Set by the supervisor in each shard process
+SHARD_IDS = [int(shard) for shard in os.getenv('FOLDA_SHARD_IDS', '').split(',') if shard]
+SHARD_PROCESS = int(os.getenv('FOLDA_SHARD_PROCESS', '0'))
+# Set by YdlProcessPool in download worker processes, which only run the yt-dlp jobs
+YDL_WORKER = os.getenv('FOLDA_YDL_WORKER') == '1'
+
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # 'text' or 'json' (one object per line)
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # records buffered for the writer thread
+# Warnings and errors from one call site beyond LOG_REPEAT_BURST per LOG_REPEAT_WINDOW seconds are suppressed
+LOG_REPEAT_BURST = int(os.getenv('LOG_REPEAT_BURST', '5'))
+LOG_REPEAT_WINDOW = float(os.getenv('LOG_REPEAT_WINDOW', '60'))
+SUPPORTED_AUDIO_EXTENSIONS = {'.mp3', '.m4a', '.mp4', '.wav', '.flac', '.ogg', '.aac', '.webm', '.opus', '.mka'}
+# Container to remux a native stream into when the downloaded one is not directly playable
+REMUX_EXTENSIONS = {'opus': '.opus', 'vorbis': '.ogg', 'mp4a': '.m4a', 'aac': '.m4a', 'mp3': '.mp3', 'flac': '.flac'}
 
 # ==================== Logging Setup ====================
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        if SHARD_IDS:
+            entry['shard_process'] = SHARD_PROCESS
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            text += f" [{record.suppressed} similar messages suppressed]"
+        return text
+
+
+class RepeatFilter(logging.Filter):
+    """Rate-limits warnings and errors per call site.
+
+    Up to `burst` records per call site pass in each `window`; the rest are
+    counted, and the count rides along on the first record of the next window.
+    """
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.suppressed_total = 0
+        self._sites: Dict[Tuple[str, int], List[float]] = {}  # (path, line) -> [window start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        now = record.created
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None or now - site[0] >= self.window:
+                if site is not None and site[2]:
+                    record.suppressed = int(site[2])
+                self._sites[(record.pathname, record.lineno)] = [now, 1, 0]
+                return True
+            site[1] += 1
+            if site[1] <= self.burst:
+                return True
+            site[2] += 1
+            self.suppressed_total += 1
+            return False
+
+
+class LogPipeline:
+    """Hands log records to a writer thread through a bounded queue.
+
+    Callers, the event loop included, never touch files or rotate logs: the
+    queue handler only formats the message and enqueues it. When the queue is
+    full the record is dropped and counted; the writer reports drops once it
+    catches up.
+    """
+
+    def __init__(self, capacity: int):
+        self.queue: Queue = Queue(maxsize=max(1, capacity))
+        self.dropped = 0
+        self.repeats = RepeatFilter(LOG_REPEAT_BURST, LOG_REPEAT_WINDOW)
+        self._targets: Dict[str, List[logging.Handler]] = {}
+        self._reported = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def connect(self, logger: logging.Logger, handlers: List[logging.Handler]) -> None:
+        self._targets[logger.name] = handlers
+        handler = _PipelineHandler(self)
+        handler.addFilter(self.repeats)
+        logger.addHandler(handler)
+        logger.propagate = False
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, name='log-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def submit(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def _write_loop(self) -> None:
+        while True:
+            try:
+                record = self.queue.get(timeout=1)
+            except Empty:
+                record = None
+            if self.dropped > self._reported:
+                dropped, self._reported = self.dropped - self._reported, self.dropped
+                self._emit(logging.makeLogRecord({
+                    'name': 'bot', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"Log buffer full: dropped {dropped} records", 'threadName': 'log-writer',
+                }))
+            if record is self:  # stop() sentinel
+                return
+            if record is not None:
+                self._emit(record)
+
+    def _emit(self, record: logging.LogRecord) -> None:
+        for handler in self._targets.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self) -> None:
+        """Flush what is queued; called at interpreter exit."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self.queue.put(self, timeout=5)
+        except Full:
+            return
+        self._thread.join(timeout=5)
+
+
+class _PipelineHandler(logging.Handler):
+    def __init__(self, pipeline: LogPipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Like QueueHandler.prepare: render the message and traceback now, since
+        # args may change after this call returns, and drop unpicklable state
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.pipeline.submit(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+log_pipeline = LogPipeline(LOG_QUEUE_SIZE)
+
+
 def setup_logger(name: str, log_file: str, level=logging.INFO) -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3)
-    file_handler.setFormatter(formatter)
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
+
+    # Download workers only log to the console they share with the bot: several
+    # processes writing and rotating the same file would interleave and race
+    if not YDL_WORKER:
+        # delay: files are only opened once something is logged to them
+        file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3, delay=True)
+        file_handler.setFormatter(formatter)
+        handlers.insert(0, file_handler)
+
+    # All handlers run on the log writer thread
+    log_pipeline.connect(logger, handlers)
     return logger
 
-bot_logger = setup_logger('bot', 'bot.log')
-cli_logger = setup_logger('cli', 'cli.log')
-yt_logger = setup_logger('yt_dlp', 'yt_dlp.log', level=logging.WARNING)
+# Shard processes log to their own files so rotation never races
+LOG_SUFFIX = f".shard{SHARD_PROCESS}" if SHARD_IDS else ""
+bot_logger = setup_logger('bot', f'bot{LOG_SUFFIX}.log')
+cli_logger = setup_logger('cli', f'cli{LOG_SUFFIX}.log')
+yt_logger = setup_logger('yt_dlp', f'yt_dlp{LOG_SUFFIX}.log', level=logging.WARNING)
+startup.mark('config + logging')
 
 # ==================== Data Tracking ====================
-DATA_USAGE = defaultdict(lambda: {'total_bytes': 0, 'start_time': time.time()})
 last_join_channels: Dict[int, discord.VoiceChannel] = {}
 
+# ==================== Metrics ====================
+class ThreadCounter:
+    """Labelled counter that each thread increments in its own cell, without locks.
+
+    Audio is sent from a player thread per voice client, so the hot path only
+    touches a thread-local dict; readers merge the cells, folding those of
+    finished threads into a retired total so short-lived threads don't pile up.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells: List[Tuple[threading.Thread, Dict[Any, int]]] = []
+        self._retired: Dict[Any, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, key: Any, amount: int = 1) -> None:
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._local.cell = defaultdict(int)
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+        cell[key] += amount
+
+    def values(self) -> Dict[Any, int]:
+        with self._lock:
+            live = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    for key, value in cell.items():
+                        self._retired[key] += value
+            self._cells = live
+            merged = defaultdict(int, self._retired)
+        for _, cell in live:
+            for key, value in dict(cell).items():
+                merged[key] += value
+        return merged
+
+    def discard(self, key: Any) -> None:
+        """Forget a label, e.g. a guild that is no longer loaded."""
+        with self._lock:
+            self._retired.pop(key, None)
+            for _, cell in self._cells:
+                cell.pop(key, None)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram; only observed from the event loop."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, name: str) -> List[str]:
+        lines, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum:.6f}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+
+class Metrics:
+    """Process metrics, served in the Prometheus text format on METRICS_HOST:METRICS_PORT."""
+    LAG_INTERVAL = 0.5
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stream_bytes = ThreadCounter()    # guild_id -> bytes
+        self.frames_sent = ThreadCounter()     # guild_id -> Opus packets
+        self.ffmpeg_processes = ThreadCounter()
+        self.cache_lookups = ThreadCounter()   # (cache, 'hit' | 'miss') -> lookups
+        self.download_seconds = Histogram((0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+        self.loop_lag_seconds = Histogram((0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    def count_audio(self, guild_id: int, size: int) -> None:
+        """Record one packet sent to a voice client; called from the audio thread."""
+        self.stream_bytes.add(guild_id, size)
+        self.frames_sent.add(guild_id)
+
+    async def start(self) -> None:
+        """Start the lag monitor and the HTTP endpoint; safe to call again on reconnect."""
+        if self._lag_task is None:
+            self._lag_task = asyncio.create_task(self._watch_loop_lag())
+        if self._server is None and METRICS_PORT:
+            try:
+                self._server = await asyncio.start_server(self._serve, METRICS_HOST, METRICS_PORT)
+                bot_logger.info(f"Metrics endpoint on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+            except OSError as e:
+                bot_logger.error(f"Could not start metrics endpoint: {e}")
+
+    async def _watch_loop_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.LAG_INTERVAL
+            await asyncio.sleep(self.LAG_INTERVAL)
+            self.loop_lag_seconds.observe(max(0.0, loop.time() - expected))
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def render(self) -> str:
+        out = []
+
+        def metric(name: str, kind: str, text: str, samples):
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples)
+
+        metric('foldatunez_start_time_seconds', 'gauge', 'Process start time.', [f'foldatunez_start_time_seconds {self.started_at:.0f}'])
+        metric('foldatunez_stream_bytes_total', 'counter', 'Opus bytes sent to voice, per guild.',
+               [f'foldatunez_stream_bytes_total{{guild="{g}"}} {v}' for g, v in self.stream_bytes.values().items()])
+        metric('foldatunez_frames_sent_total', 'counter', 'Opus packets sent to voice, per guild.',
+               [f'foldatunez_frames_sent_total{{guild="{g}"}} {v}' for g, v in self.frames_sent.values().items()])
+        metric('foldatunez_voice_connections', 'gauge', 'Connected voice clients.',
+               [f'foldatunez_voice_connections {sum(1 for vc in bot.voice_clients if vc.is_connected())}'])
+        metric('foldatunez_guild_states', 'gauge', 'Guilds with state loaded in memory.',
+               [f'foldatunez_guild_states {len(guild_states)}'])
+        metric('foldatunez_queue_depth', 'gauge', 'Tracks waiting in each guild queue.',
+               [f'foldatunez_queue_depth{{guild="{g}"}} {len(state.queue)}' for g, state in list(guild_states.items())])
+        metric('foldatunez_download_queue_depth', 'gauge', 'yt-dlp jobs waiting for a worker.',
+               [f'foldatunez_download_queue_depth {downloader.scheduler.pending}'])
+        metric('foldatunez_downloads_running', 'gauge', 'yt-dlp jobs currently running.',
+               [f'foldatunez_downloads_running {downloader.scheduler.running}'])
+        lookups = self.cache_lookups.values()
+        metric('foldatunez_cache_lookups_total', 'counter', 'Track and metadata cache lookups by result.',
+               [f'foldatunez_cache_lookups_total{{cache="{c}",result="{r}"}} {v}' for (c, r), v in lookups.items()])
+        ratios = []
+        for cache in sorted({c for c, _ in lookups}):
+            hits, misses = lookups.get((cache, 'hit'), 0), lookups.get((cache, 'miss'), 0)
+            ratios.append(f'foldatunez_cache_hit_ratio{{cache="{cache}"}} {hits / max(1, hits + misses):.4f}')
+        metric('foldatunez_cache_hit_ratio', 'gauge', 'Cache hits over lookups since start.', ratios)
+        metric('foldatunez_download_duration_seconds', 'histogram', 'Track download time, from request to file on disk.',
+               self.download_seconds.render('foldatunez_download_duration_seconds'))
+        metric('foldatunez_ffmpeg_processes', 'gauge', 'Running ffmpeg playback processes.',
+               [f"foldatunez_ffmpeg_processes {self.ffmpeg_processes.values().get('running', 0)}"])
+        metric('foldatunez_log_records_dropped_total', 'counter', 'Log records dropped because the log buffer was full.',
+               [f'foldatunez_log_records_dropped_total {log_pipeline.dropped}'])
+        metric('foldatunez_log_records_suppressed_total', 'counter', 'Repeated warnings and errors suppressed by rate limiting.',
+               [f'foldatunez_log_records_suppressed_total {log_pipeline.repeats.suppressed_total}'])
+        metric('foldatunez_event_loop_lag_seconds', 'histogram', 'How late the event loop runs a scheduled wakeup.',
+               self.loop_lag_seconds.render('foldatunez_event_loop_lag_seconds'))
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+# ==================== Tracing ====================
+class Trace:
+    """Timed spans for one track request, from the command to the first audio packet."""
+
+    def __init__(self, name: str, guild_id: int, requester: str, **attrs):
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.attrs = {'guild_id': guild_id, 'requester': requester, **attrs}
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.enqueued_at: Optional[float] = None
+        self.spans: List[Dict[str, Any]] = []
+
+    def add_span(self, name: str, start: float, end: float, **attrs) -> None:
+        self.spans.append({'name': name, 'span_id': os.urandom(8).hex(), 'start': start, 'end': end, 'attrs': attrs})
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time a block; the yielded dict collects attributes set inside it."""
+        start = time.time()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs['error'] = repr(e)
+            raise
+        finally:
+            self.add_span(name, start, time.time(), **attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'attrs': self.attrs,
+            'spans': [{**span, 'duration_ms': round((span['end'] - span['start']) * 1000, 2)} for span in self.spans],
+        }
+
+
+# The trace of the request being served by the current task, if any
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+def trace_span(name: str, **attrs):
+    """Time a block under the current trace; a no-op outside of one."""
+    trace = current_trace.get()
+    return trace.span(name, **attrs) if trace else nullcontext(attrs)
+
+def trace_spans(spans: List[Tuple[str, float, float]]) -> None:
+    """Add spans timed elsewhere (e.g. inside a download worker) to the current trace."""
+    trace = current_trace.get()
+    if trace:
+        for name, start, end in spans:
+            trace.add_span(name, start, end)
+
+
+class Tracer:
+    """Collects finished traces, keeps per-stage latency samples and exports traces.
+
+    Export runs on a background thread so a slow disk or collector never
+    blocks playback; when its buffer is full, traces are dropped and counted.
+    """
+    # Spans that measure a person rather than the bot; left out of the total
+    IDLE_STAGES = ('user_select',)
+    EXPORT_BUFFER = 1000
+
+    def __init__(self, export: str, samples: int):
+        self.export = export
+        self.stages: Dict[str, deque] = defaultdict(lambda: deque(maxlen=samples))
+        self.dropped = 0
+        self._pending: Queue = Queue(maxsize=self.EXPORT_BUFFER)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, name: str, guild_id: int, requester: str, **attrs) -> Trace:
+        """Begin a trace and make it current for this task."""
+        trace = Trace(name, guild_id, requester, **attrs)
+        current_trace.set(trace)
+        return trace
+
+    def attach(self, song: 'Track') -> None:
+        """Hand the current trace to a queued song; the player finishes it at the first packet."""
+        trace = current_trace.get()
+        if trace and trace.end is None:
+            trace.enqueued_at = time.time()
+            song.trace = trace
+
+    def resume(self, song: 'Track') -> Optional[Trace]:
+        """Make a dequeued song's trace current and record how long it waited in the queue."""
+        trace, song.trace = song.trace, None
+        if trace and trace.enqueued_at:
+            trace.add_span('queued', trace.enqueued_at, time.time())
+        current_trace.set(trace)
+        return trace
+
+    def finish(self, trace: Optional[Trace], error: Optional[str] = None) -> None:
+        if trace is None or trace.end is not None:
+            return
+        trace.end = time.time()
+        idle = 0.0
+        for span in trace.spans:
+            duration = span['end'] - span['start']
+            self.stages[span['name']].append(duration * 1000)
+            if span['name'] in self.IDLE_STAGES:
+                idle += duration
+        if error:
+            trace.attrs['error'] = error
+        else:
+            self.stages['total'].append((trace.end - trace.start - idle) * 1000)
+
+        if self.export == 'off':
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._export_loop, name='trace-export', daemon=True)
+            self._thread.start()
+        try:
+            self._pending.put_nowait(trace)
+        except Full:
+            self.dropped += 1
+
+    def summary(self) -> Dict[str, Tuple[int, float, float, float]]:
+        """Sample count and p50/p95/p99 in milliseconds per stage."""
+        result = {}
+        for stage, samples in list(self.stages.items()):
+            values = sorted(samples)
+            if values:
+                pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+                result[stage] = (len(values), pick(0.50), pick(0.95), pick(0.99))
+        return result
+
+    def _export_loop(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            while not self._pending.empty() and len(batch) < 100:
+                batch.append(self._pending.get_nowait())
+            try:
+                if self.export == 'otlp':
+                    self._export_otlp(batch)
+                else:
+                    with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+                        for trace in batch:
+                            f.write(json.dumps(trace.to_dict(), default=str) + '\n')
+            except Exception as e:
+                bot_logger.warning(f"Trace export failed ({len(batch)} traces): {e}")
+
+    @staticmethod
+    def _otlp_attrs(attrs: Dict[str, Any]) -> List[Dict[str, Any]]:
+        def value(v):
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': str(v)}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': str(v)}
+        return [{'key': k, 'value': value(v)} for k, v in attrs.items() if v is not None]
+
+    def _export_otlp(self, batch: List[Trace]) -> None:
+        """POST traces to an OTLP/HTTP collector using the JSON encoding."""
+        nanos = lambda t: str(int(t * 1e9))
+        spans = []
+        for trace in batch:
+            spans.append({
+                'traceId': trace.trace_id, 'spanId': trace.span_id, 'name': trace.name, 'kind': 2,
+                'startTimeUnixNano': nanos(trace.start), 'endTimeUnixNano': nanos(trace.end),
+                'attributes': self._otlp_attrs(trace.attrs),
+                'status': {'code': 2 if 'error' in trace.attrs else 1},
+            })
+            for span in trace.spans:
+                spans.append({
+                    'traceId': trace.trace_id, 'spanId': span['span_id'], 'parentSpanId': trace.span_id,
+                    'name': span['name'], 'kind': 1,
+                    'startTimeUnixNano': nanos(span['start']), 'endTimeUnixNano': nanos(span['end']),
+                    'attributes': self._otlp_attrs(span['attrs']),
+                })
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': self._otlp_attrs({'service.name': 'folda-tunez'})},
+            'scopeSpans': [{'scope': {'name': 'FoldaTunezBot'}, 'spans': spans}],
+        }]}
+        request = urllib.request.Request(
+            TRACE_OTLP_ENDPOINT, data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+tracer = Tracer(TRACE_EXPORT, TRACE_SAMPLES)
+
+# ==================== Tracks ====================
+class Track:
+    """One queued song, shared by reference between the queue, history and current_song.
+
+    Slotted rather than a dict, since busy processes hold millions of these;
+    requester and codec strings are interned so each distinct value is stored
+    once. pack() is the compact list form used by queue persistence and for
+    sending tracks between processes.
+    """
+    __slots__ = ('title', 'url', 'webpage_url', 'duration', '_requester', 'acodec', 'status', 'resume_at', 'size',
+                 'trace')
+    # Field order of the packed form; append only, old snapshots depend on it
+    FIELDS = ('title', 'url', 'webpage_url', 'duration', 'requester', 'acodec', 'status', 'resume_at', 'size')
+
+    def __init__(self, title: str, url: str, webpage_url: Optional[str] = None, duration: int = 0,
+                 requester: Optional[str] = None, acodec: Optional[str] = None, status: Optional[str] = None,
+                 resume_at: float = 0, size: int = 0):
+        self.title = title
+        self.url = url  # local path once downloaded, the page URL while pending
+        self.webpage_url = webpage_url
+        self.duration = int(duration or 0)
+        self.requester = requester
+        self.acodec = sys.intern(acodec) if acodec else None
+        self.status = status  # None when playable, 'pending' or 'failed'
+        self.resume_at = resume_at  # set on tracks restored mid-play
+        self.size = size  # bytes, recorded once the file is known to be complete; 0 if unchecked
+        self.trace: Optional['Trace'] = None
+
+    @property
+    def requester(self) -> Optional[str]:
+        return self._requester
+
+    @requester.setter
+    def requester(self, name: Optional[str]) -> None:
+        self._requester = sys.intern(name) if name else None
+
+    def update_from(self, other: 'Track') -> None:
+        """Take the resolved file and details of a downloaded copy, keeping the requester."""
+        self.title = other.title
+        self.url = other.url
+        self.webpage_url = other.webpage_url or self.webpage_url
+        self.duration = other.duration
+        self.acodec = other.acodec
+        self.size = other.size
+        self.status = None
+
+    def pack(self) -> List[Any]:
+        packed = [self.title, self.url, self.webpage_url, self.duration, self.requester,
+                  self.acodec, self.status, self.resume_at, self.size]
+        # Trailing defaults are dropped; title and url are always kept, since unpack() needs them
+        while len(packed) > 2 and not packed[-1]:
+            packed.pop()
+        return packed
+
+    @classmethod
+    def unpack(cls, packed: List[Any]) -> 'Track':
+        return cls(*packed)
+
+    @classmethod
+    def load(cls, data: Union[List[Any], Dict[str, Any]]) -> 'Track':
+        """Rebuild a track from pack() output, or from the dicts older queue snapshots hold."""
+        if isinstance(data, dict):
+            return cls(**{name: data[name] for name in cls.FIELDS if name in data})
+        return cls.unpack(data)
+
+    def __reduce__(self):
+        # Pickle (e.g. results from download worker processes) as the packed list
+        return Track.unpack, (self.pack(),)
+
+    def __repr__(self) -> str:
+        return f"Track({self.title!r}, {self.url!r}, status={self.status!r})"
+
+
+# ==================== Track Queue ====================
+class TrackQueue:
+    """Indexed track queue with stable track IDs.
+
+    Tracks sit in a flat slot array with gaps; a Fenwick tree over slot occupancy
+    gives O(log n) positional lookup, removal and move-to-front, amortized O(1)
+    inserts at either end and an in-place shuffle that never reorders the tree.
+    """
+
+    MIN_ROOM = 16
+
+    def __init__(self, items: Optional[List[Track]] = None):
+        self._next_id = 1
+        self._slot_of: Dict[int, int] = {}
+        self._durations: Dict[int, int] = {}
+        self._lines: Dict[int, str] = {}
+        self._size = 0
+        self.total_duration = 0
+        self._not_empty = asyncio.Event()
+        self.version = 0
+        # Called with (op, data) for every change; used by the persistence journal
+        self.listener: Optional[Callable[[str, Dict[str, Any]], None]] = None
+        self._rebuild([], self.MIN_ROOM, self.MIN_ROOM)
+        if items:
+            self.extend(items)
+
+    # ----- Fenwick tree helpers -----
+    def _rebuild(self, live: List[Tuple[int, Track]], front_room: int, back_room: int) -> None:
+        capacity = front_room + len(live) + back_room
+        self._slots: List[Optional[Track]] = [None] * capacity
+        self._ids = [0] * capacity
+        self._head = front_room
+        self._tail = front_room + len(live)
+        self._slot_of.clear()
+        tree = [0] * (capacity + 1)
+        for offset, (track_id, item) in enumerate(live):
+            slot = front_room + offset
+            self._slots[slot] = item
+            self._ids[slot] = track_id
+            self._slot_of[track_id] = slot
+            tree[slot + 1] = 1
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._top_bit = 1 << (capacity.bit_length() - 1)
+
+    def _live(self) -> List[Tuple[int, Track]]:
+        return [(self._ids[i], self._slots[i]) for i in range(self._head, self._tail)
+                if self._slots[i] is not None]
+
+    def _update(self, slot: int, delta: int) -> None:
+        i = slot + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _find(self, index: int) -> int:
+        """Slot holding the track at 0-based queue position `index`."""
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("queue index out of range")
+        pos, remaining, step = 0, index + 1, self._top_bit
+        tree = self._tree
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] < remaining:
+                pos = nxt
+                remaining -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def _place(self, slot: int, item: Track) -> int:
+        track_id = self._next_id
+        self._next_id += 1
+        self._slots[slot] = item
+        self._ids[slot] = track_id
+        self._slot_of[track_id] = slot
+        self._update(slot, 1)
+        self._size += 1
+        duration = item.duration
+        self._durations[track_id] = duration
+        self.total_duration += duration
+        return track_id
+
+    def _vacate(self, slot: int) -> Track:
+        item = self._slots[slot]
+        track_id = self._ids[slot]
+        self._slots[slot] = None
+        del self._slot_of[track_id]
+        self.total_duration -= self._durations.pop(track_id, 0)
+        self._lines.pop(track_id, None)
+        self._update(slot, -1)
+        self._size -= 1
+        while self._head < self._tail and self._slots[self._head] is None:
+            self._head += 1
+        while self._tail > self._head and self._slots[self._tail - 1] is None:
+            self._tail -= 1
+        # Compact once gaps outnumber tracks so iteration stays O(n)
+        if self._tail - self._head > 2 * self._size + self.MIN_ROOM:
+            room = max(self.MIN_ROOM, self._size // 2)
+            self._rebuild(self._live(), room, room)
+        return item
+
+    def _notify(self, op: str, **data) -> None:
+        if self.listener:
+            self.listener(op, data)
+
+    def _changed(self) -> None:
+        self.version += 1
+        if self._size:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+
+    # ----- Public API -----
+    def approx_bytes(self) -> int:
+        """Rough memory held by the tracks, index structures and cached display lines."""
+        return (_approx_size(self.entries(0, self._size)) + _approx_size(self._lines, depth=2)
+                + sys.getsizeof(self._slots) + sys.getsizeof(self._ids) + sys.getsizeof(self._tree)
+                + sys.getsizeof(self._slot_of) + sys.getsizeof(self._durations))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def __iter__(self):
+        for item in self.snapshot():
+            yield item
+
+    def __getitem__(self, index: int) -> Track:
+        return self._slots[self._find(index)]
+
+    def snapshot(self) -> List[Track]:
+        """Copy of the queue in order; safe to call from other threads."""
+        return [item for item in self._slots[self._head:self._tail] if item is not None]
+
+    def slice(self, start: int, stop: int) -> List[Track]:
+        """Tracks at positions [start, stop) without walking the queue before them."""
+        return [item for _, item in self.entries(start, stop)]
+
+    def append(self, item: Track) -> int:
+        if self._tail == len(self._slots):
+            self._rebuild(self._live(), max(self.MIN_ROOM, self._size // 2), max(self.MIN_ROOM, self._size))
+        track_id = self._place(self._tail, item)
+        self._tail += 1
+        self._changed()
+        self._notify('add', ids=[track_id], tracks=[item], front=False)
+        return track_id
+
+    def appendleft(self, item: Track) -> int:
+        if self._head == 0:
+            self._rebuild(self._live(), max(self.MIN_ROOM, self._size), max(self.MIN_ROOM, self._size // 2))
+        self._head -= 1
+        track_id = self._place(self._head, item)
+        self._changed()
+        self._notify('add', ids=[track_id], tracks=[item], front=True)
+        return track_id
+
+    def extend(self, items: List[Track], front: bool = False) -> List[int]:
+        """Bulk insert at the back (or, keeping their order, at the front)."""
+        items = list(items)
+        if front:
+            if self._head < len(items):
+                self._rebuild(self._live(), max(self.MIN_ROOM, len(items) + self._size // 2), self.MIN_ROOM)
+            start = self._head - len(items)
+            ids = [self._place(start + offset, item) for offset, item in enumerate(items)]
+            self._head = start
+        else:
+            if len(self._slots) - self._tail < len(items):
+                self._rebuild(self._live(), self.MIN_ROOM, max(self.MIN_ROOM, len(items) + self._size // 2))
+            start = self._tail
+            ids = [self._place(start + offset, item) for offset, item in enumerate(items)]
+            self._tail = start + len(items)
+        self._changed()
+        self._notify('add', ids=ids, tracks=items, front=front)
+        return ids
+
+    def pop(self, index: int = 0) -> Track:
+        slot = self._find(index)
+        track_id = self._ids[slot]
+        item = self._vacate(slot)
+        self._changed()
+        self._notify('remove', ids=[track_id])
+        return item
+
+    def popleft(self) -> Optional[Track]:
+        return self.pop(0) if self._size else None
+
+    async def get(self) -> Track:
+        """Wait for and remove the next track."""
+        while not self._size:
+            await self._not_empty.wait()
+        return self.pop(0)
+
+    def remove_id(self, track_id: int) -> Optional[Track]:
+        slot = self._slot_of.get(track_id)
+        if slot is None:
+            return None
+        item = self._vacate(slot)
+        self._changed()
+        self._notify('remove', ids=[track_id])
+        return item
+
+    def id_at(self, index: int) -> int:
+        return self._ids[self._find(index)]
+
+    def entries(self, start: int, stop: int) -> List[Tuple[int, Track]]:
+        """(track ID, track) pairs at positions [start, stop)."""
+        start, stop = max(start, 0), min(stop, self._size)
+        if start >= stop:
+            return []
+        entries = []
+        slot = self._find(start)
+        while len(entries) < stop - start:
+            if self._slots[slot] is not None:
+                entries.append((self._ids[slot], self._slots[slot]))
+            slot += 1
+        return entries
+
+    def refresh(self, track_id: int) -> None:
+        """Re-read a track that was updated in place (e.g. resolved from a lazy entry)."""
+        slot = self._slot_of.get(track_id)
+        if slot is None:
+            return
+        duration = self._slots[slot].duration
+        self.total_duration += duration - self._durations.get(track_id, 0)
+        self._durations[track_id] = duration
+        self._lines.pop(track_id, None)
+        self._changed()
+        self._notify('update', id=track_id, track=self._slots[slot])
+
+    def lines(self, start: int, stop: int, render) -> List[str]:
+        """Display lines for positions [start, stop); each track is rendered once until it changes."""
+        lines = []
+        for track_id, item in self.entries(start, stop):
+            line = self._lines.get(track_id)
+            if line is None:
+                line = self._lines[track_id] = render(item)
+            lines.append(line)
+        return lines
+
+    def move_to_front(self, index: int) -> Track:
+        item = self.pop(index)
+        self.appendleft(item)
+        return item
+
+    def shuffle(self) -> None:
+        """Shuffle in place; occupied slots stay where they are, so the tree is untouched."""
+        occupied = [i for i in range(self._head, self._tail) if self._slots[i] is not None]
+        for n in range(len(occupied) - 1, 0, -1):
+            a, b = occupied[n], occupied[random.randint(0, n)]
+            self._slots[a], self._slots[b] = self._slots[b], self._slots[a]
+            self._ids[a], self._ids[b] = self._ids[b], self._ids[a]
+        for slot in occupied:
+            self._slot_of[self._ids[slot]] = slot
+        self._changed()
+        self._notify('order', ids=[self._ids[slot] for slot in occupied])
+
+    def clear(self) -> None:
+        self._size = 0
+        self.total_duration = 0
+        self._durations.clear()
+        self._lines.clear()
+        self._rebuild([], self.MIN_ROOM, self.MIN_ROOM)
+        self._changed()
+        self._notify('clear')
+
+# ==================== Queue Persistence ====================
+class QueueStore:
+    """Crash-safe per-guild persistence of queue, history, loop mode and position.
+
+    Each guild has <guild>.snapshot, written atomically, and <guild>.<gen>.journal
+    with one JSON change per line since snapshot <gen>. Changes are queued on
+    the event loop and appended by a writer thread, which fsyncs once per flush
+    interval; a torn last line from a crash is ignored on replay. After
+    COMPACT_AFTER changes a guild is compacted into a new snapshot. Guilds are
+    restored on first use, not at startup.
+    """
+    COMPACT_AFTER = 1000
+    FLUSH_INTERVAL = 1.0
+    POSITION_INTERVAL = 15
+
+    def __init__(self, root: str, enabled: bool):
+        self.root = root
+        self.enabled = enabled
+        self._pending: Queue = Queue()
+        self._counts: Dict[int, int] = defaultdict(int)
+        self._generations: Dict[int, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._ticker: Optional[asyncio.Task] = None
+        # Snapshots queued but not yet on disk, so a guild evicted and reloaded within a flush reads them
+        self._unwritten: Dict[int, Dict[str, Any]] = {}
+        self._unwritten_lock = threading.Lock()
+        if enabled:
+            os.makedirs(root, exist_ok=True)
+
+    def _snapshot_path(self, guild_id: int) -> str:
+        return os.path.join(self.root, f"{guild_id}.snapshot")
+
+    def _journal_path(self, guild_id: int, gen: int) -> str:
+        return os.path.join(self.root, f"{guild_id}.{gen}.journal")
+
+    # ----- Event loop side -----
+    def start(self) -> None:
+        """Start journaling playback positions; safe to call again on reconnect."""
+        if self.enabled and self._ticker is None:
+            self._ticker = asyncio.create_task(self._tick_positions())
+
+    def attach(self, state: 'GuildState') -> None:
+        """Restore a guild's saved state in the background, then journal every change to it.
+
+        Files are read in the executor; state.loaded is set once the restore is done.
+        """
+        if not self.enabled:
+            state.loaded.set()
+            return
+        asyncio.create_task(self._attach(state))
+
+    async def _attach(self, state: 'GuildState') -> None:
+        try:
+            gen, saved = await asyncio.get_running_loop().run_in_executor(None, self._load, state.guild_id)
+            self._generations[state.guild_id] = gen
+            if saved is not None:
+                self._restore(state, *saved)
+        except Exception as e:
+            bot_logger.error(f"Could not restore queue for guild {state.guild_id}: {traceback.format_exc()}")
+        finally:
+            state.queue.listener = lambda op, data: self.record(state, op, **data)
+            state.loaded.set()
+
+    def record(self, state: 'GuildState', op: str, **data) -> None:
+        if not self.enabled:
+            return
+        if 'tracks' in data:
+            data['tracks'] = [track.pack() for track in data['tracks']]
+        if data.get('track') is not None:
+            data['track'] = data['track'].pack()
+        guild_id = state.guild_id
+        self._submit(guild_id, 'entry', {'op': op, **data})
+        self._counts[guild_id] += 1
+        if self._counts[guild_id] >= self.COMPACT_AFTER:
+            self.compact(state)
+
+    def compact(self, state: 'GuildState') -> None:
+        """Queue a full snapshot of the guild; later changes go to a fresh journal."""
+        guild_id = state.guild_id
+        self._counts[guild_id] = 0
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        playing = state.is_playing and state.current_song is not None
+        snapshot = {
+            'gen': self._generations[guild_id],
+            'queue': [[track_id, track.pack()] for track_id, track in state.queue.entries(0, len(state.queue))],
+            'history': [track.pack() for track in state.history],
+            'current': state.current_song.pack() if playing else None,
+            'position': round(time.time() - state.start_time, 1) if playing else 0,
+            'loop_type': state.loop_type,
+        }
+        with self._unwritten_lock:
+            self._unwritten[guild_id] = snapshot
+        self._submit(guild_id, 'snapshot', snapshot)
+
+    def spill(self, state: 'GuildState') -> bool:
+        """Snapshot an idle guild so it can be dropped from memory; attach() brings it back.
+
+        Without persistence only guilds with an empty queue can be dropped.
+        """
+        if not self.enabled:
+            return not state.queue
+        state.queue.listener = None
+        self.compact(state)
+        self._counts.pop(state.guild_id, None)
+        return True
+
+    def forget(self, guild_id: int) -> None:
+        if self.enabled:
+            with self._unwritten_lock:
+                self._unwritten.pop(guild_id, None)
+            self._submit(guild_id, 'forget', None)
+            self._counts.pop(guild_id, None)
+
+    def _submit(self, guild_id: int, kind: str, payload: Any) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, name='queue-store', daemon=True)
+            self._thread.start()
+        self._pending.put((guild_id, self._generations.get(guild_id, 0), kind, payload))
+
+    async def _tick_positions(self) -> None:
+        while True:
+            await asyncio.sleep(self.POSITION_INTERVAL)
+            for state in list(guild_states.values()):
+                if state.is_playing and state.current_song:
+                    self.record(state, 'position', seconds=round(time.time() - state.start_time, 1))
+
+    def _load(self, guild_id: int):
+        """Read and replay a guild's snapshot and journal; runs in the executor.
+
+        Returns the snapshot generation and (tracks, history, loop_type), or None if nothing was saved.
+        """
+        with self._unwritten_lock:
+            unwritten = self._unwritten.get(guild_id)
+        snapshot = {}
+        if unwritten is not None:
+            snapshot = unwritten  # read only; tracks are rebuilt from the packed lists
+        elif os.path.exists(self._snapshot_path(guild_id)):
+            with open(self._snapshot_path(guild_id), encoding='utf-8') as f:
+                snapshot = json.load(f)
+        gen = snapshot.get('gen', 0)
+        journal = self._journal_path(guild_id, gen)
+        lines = []
+        if unwritten is None and os.path.exists(journal):
+            with open(journal, encoding='utf-8') as f:
+                lines = f.readlines()
+        if not snapshot and not lines:
+            return gen, None
+
+        queue, history, current, position, loop_type = self._replay(snapshot, lines)
+        if current is not None:
+            # Put the interrupted track back at the front, to resume where it stopped
+            if history and history[-1] == current:
+                history.pop()
+            queue[0] = current  # track IDs start at 1
+            queue.move_to_end(0, last=False)
+        tracks = [Track.load(track) for track in queue.values()]
+        history = [Track.load(track) for track in history]
+        if current is not None and position:
+            tracks[0].resume_at = position
+        for track in tracks + history:
+            # Cached files are reused as is; anything gone is re-resolved lazily by the prefetcher
+            if track.webpage_url and not os.path.exists(track.url):
+                track.status = 'pending'
+        return gen, (tracks, history, loop_type)
+
+    def _restore(self, state: 'GuildState', tracks: List[Track], history: List[Track],
+                 loop_type: Optional[str]) -> None:
+        state.queue.extend(tracks)
+        state.history = deque(history)
+        state.set_loop(loop_type)
+        bot_logger.info(f"Restored {len(tracks)} queued tracks for guild {state.guild_id}")
+        # Re-base on the new track IDs
+        self.compact(state)
+
+    @staticmethod
+    def _replay(snapshot: Dict[str, Any], lines: List[str]):
+        queue = OrderedDict((track_id, track) for track_id, track in snapshot.get('queue', []))
+        history = list(snapshot.get('history', []))
+        current = snapshot.get('current')
+        position = snapshot.get('position', 0)
+        loop_type = snapshot.get('loop_type')
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # torn write from a crash; nothing after it was committed
+            op = entry['op']
+            if op == 'add':
+                pairs = list(zip(entry['ids'], entry['tracks']))
+                if entry.get('front'):
+                    for track_id, track in reversed(pairs):
+                        queue[track_id] = track
+                        queue.move_to_end(track_id, last=False)
+                else:
+                    queue.update(pairs)
+            elif op == 'remove':
+                for track_id in entry['ids']:
+                    queue.pop(track_id, None)
+            elif op == 'order':
+                queue = OrderedDict((track_id, queue[track_id]) for track_id in entry['ids'] if track_id in queue)
+            elif op == 'clear':
+                queue.clear()
+            elif op == 'update':
+                if entry['id'] in queue:
+                    queue[entry['id']] = entry['track']
+            elif op == 'play':
+                if not entry.get('replay'):
+                    history.append(entry['track'])
+                    current = entry['track']
+                position = 0
+            elif op == 'position':
+                position = entry['seconds']
+            elif op == 'idle':
+                current, position = None, 0
+            elif op == 'loop':
+                loop_type = entry['mode']
+            elif op == 'rewind':
+                history = []
+            elif op == 'reset':
+                history, current, position, loop_type = [], None, 0, None
+        return queue, history, current, position, loop_type
+
+    # ----- Writer thread -----
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            time.sleep(self.FLUSH_INTERVAL)  # let changes pile up: one write and fsync per guild
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except Empty:
+                    break
+            lines: Dict[Tuple[int, int], List[str]] = OrderedDict()
+            for guild_id, gen, kind, payload in batch:
+                try:
+                    if kind == 'entry':
+                        lines.setdefault((guild_id, gen), []).append(json.dumps(payload))
+                        continue
+                    for key in [key for key in lines if key[0] == guild_id]:
+                        self._append(*key, lines.pop(key))
+                    if kind == 'snapshot':
+                        self._write_snapshot(guild_id, gen, payload)
+                        with self._unwritten_lock:
+                            if self._unwritten.get(guild_id) is payload:
+                                del self._unwritten[guild_id]
+                    elif kind == 'forget':
+                        self._delete(guild_id)
+                except Exception as e:
+                    bot_logger.error(f"Queue persistence failed for guild {guild_id}: {str(e)}")
+            for (guild_id, gen), guild_lines in lines.items():
+                try:
+                    self._append(guild_id, gen, guild_lines)
+                except Exception as e:
+                    bot_logger.error(f"Queue persistence failed for guild {guild_id}: {str(e)}")
+
+    def _append(self, guild_id: int, gen: int, lines: List[str]) -> None:
+        with open(self._journal_path(guild_id, gen), 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, guild_id: int, gen: int, data: Dict[str, Any]) -> None:
+        path = self._snapshot_path(guild_id)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        # The snapshot covers everything before it; a crash before this leaves an ignored journal
+        for old in (gen - 1, gen - 2):
+            try:
+                os.remove(self._journal_path(guild_id, old))
+            except FileNotFoundError:
+                pass
+
+    def _delete(self, guild_id: int) -> None:
+        prefix = f"{guild_id}."
+        for name in os.listdir(self.root):
+            if name.startswith(prefix):
+                os.remove(os.path.join(self.root, name))
+
+queue_store = QueueStore(QUEUE_STATE_DIR, PERSIST_QUEUES)
+
 # ==================== Guild State Management ====================
 @dataclass
 class GuildState:
     """Represents the state of the bot in a specific guild."""
+    RETRY_DELAY = 1.0  # seconds before the player tries again after an unexpected error
+
     guild_id: int
-    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
-    queue_list: List[Dict[str, Any]] = field(default_factory=list)
-    history: List[Dict[str, Any]] = field(default_factory=list)
-    current_song: Optional[Dict[str, Any]] = None
+    queue: TrackQueue = field(default_factory=TrackQueue)
+    history: deque = field(default_factory=lambda: deque(maxlen=HISTORY_SIZE))
+    current_song: Optional[Track] = None
     loop_type: Optional[str] = None  # 'queue', 'song', or None
     is_playing: bool = False
     playback_active: bool = False
     playback_task: Optional[asyncio.Task] = None
     voice_client: Optional[discord.VoiceClient] = None
     lock: asyncio.Lock = field(default_factory=asyncio.Lock)
-    download_semaphore: asyncio.Semaphore = field(default_factory=lambda: asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS))
+    prefetch_tasks: Dict[int, asyncio.Task] = field(default_factory=dict)
+    wake: asyncio.Event = field(default_factory=asyncio.Event)
+    loaded: asyncio.Event = field(default_factory=asyncio.Event)  # set once the saved queue is restored
     start_time: float = 0.0
     last_activity: float = field(default_factory=time.time)
-    data_usage: int = 0
+    created_at: float = field(default_factory=time.time)
+
+    def set_loop(self, mode: Optional[str]) -> None:
+        """Change loop mode; the history cap is lifted while looping the queue, which replays all of it."""
+        self.loop_type = mode
+        maxlen = None if mode == 'queue' else HISTORY_SIZE
+        if self.history.maxlen != maxlen:
+            self.history = deque(self.history, maxlen=maxlen)
+
+    def schedule_prefetch(self) -> None:
+        """Get the next PREFETCH_WINDOW tracks ready and drop prefetches that left the window.
+
+        Pending tracks are downloaded; ready ones whose file was never checked
+        (local files, restored queues) are validated while the current track plays.
+        """
+        window = dict(self.queue.entries(0, PREFETCH_WINDOW))
+        for key in [k for k in self.prefetch_tasks if k not in window]:
+            self.prefetch_tasks.pop(key).cancel()
+        for key, song in window.items():
+            if key in self.prefetch_tasks:
+                continue
+            if song.status == 'pending':
+                task = asyncio.create_task(self._resolve_song(song, key))
+            elif not song.status and not song.size and song.url not in downloader.progressive:
+                task = asyncio.create_task(self._check_file(song))
+            else:
+                continue
+            task.add_done_callback(lambda t, k=key: self._forget_prefetch(k, t))
+            self.prefetch_tasks[key] = task
+
+    async def _check_file(self, song: Track) -> bool:
+        try:
+            song.url, song.size = await asyncio.get_running_loop().run_in_executor(None, resolve_audio_file, song.url)
+            return True
+        except (OSError, ValueError):
+            return False  # left unchecked; the player reports it when the track comes up
+
+    def _forget_prefetch(self, key: int, task: asyncio.Task) -> None:
+        if self.prefetch_tasks.get(key) is task:
+            del self.prefetch_tasks[key]
+
+    def cancel_prefetch(self) -> None:
+        for task in self.prefetch_tasks.values():
+            task.cancel()
+        self.prefetch_tasks.clear()
+
+    async def resolve_song(self, song: Track, track_id: int) -> bool:
+        """Make sure a lazily queued track is downloaded, reusing its prefetch if one is running."""
+        if song.status != 'pending':
+            return song.status != 'failed'
+        task = self.prefetch_tasks.pop(track_id, None)
+        if task is None:
+            return await self._resolve_song(song, track_id, interactive=True)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            return await self._resolve_song(song, track_id, interactive=True)
+
+    async def _resolve_song(self, song: Track, track_id: int, interactive: bool = False) -> bool:
+        # Prefetch tasks inherit whichever trace scheduled them; time the download under the song's own
+        token = current_trace.set(song.trace)
+        try:
+            resolved = await downloader.download_single(song.webpage_url, guild_id=self.guild_id,
+                                                        interactive=interactive)
+        finally:
+            current_trace.reset(token)
+        if not resolved:
+            song.status = 'failed'
+            return False
+        # Update in place: the same object is referenced by the queue and history
+        song.update_from(resolved)
+        self.queue.refresh(track_id)
+        return True
+
+    def wake_player(self) -> None:
+        """Signal the playback loop that something changed (enqueue, skip, reconnect)."""
+        self.wake.set()
+
+    def _advance(self) -> None:
+        """Give up on the current track and let the playback loop move on to the next one."""
+        self.is_playing = False
+        self.playback_active = False
+        self.wake.set()
 
     async def start_playback_loop(self, ctx: commands.Context) -> None:
-        """Start dedicated playback loop for this guild."""
+        """Start dedicated playback loop for this guild, or wake it if already running."""
+        self.wake.set()
         if self.playback_task and not self.playback_task.done():
             return
         self.playback_task = asyncio.create_task(self._playback_loop(ctx))
@@ -109,20 +1502,26 @@ class GuildState:
         bot_logger.info(f"Stopped playback loop for guild {self.guild_id}")
 
     async def _playback_loop(self, ctx: commands.Context) -> None:
-        """Main playback loop."""
+        """Main playback loop.
+
+        Sleeps until woken by a track finishing, an enqueue, a skip or a voice
+        reconnect, so an idle guild costs no wakeups. This task is the only
+        caller of _play_next_safe, which rules out concurrent starts.
+        """
         while True:
             try:
+                await self.wake.wait()
+                self.wake.clear()
                 if not self.playback_active and not self.is_playing:
                     await self._play_next_safe(ctx)
-                await asyncio.sleep(1)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 bot_logger.error(f"Playback loop error in guild {self.guild_id}: {traceback.format_exc()}")
-                await asyncio.sleep(5)
 
     async def _play_next_safe(self, ctx: commands.Context) -> None:
-        """Thread-safe next song playback with proper state management."""
+        """Start the next song; only called from the playback loop."""
+        current_trace.set(None)
         try:
             if self.playback_active or (ctx.voice_client and ctx.voice_client.is_playing()):
                 return
@@ -152,155 +1551,697 @@ class GuildState:
                     self.playback_active = False
                     return
 
-            # Get next song, skipping any marked as removed
+            # Get next song
             song = None
+            track_id = 0
             if self.loop_type == 'song' and self.current_song:
                 song = self.current_song
+                queue_store.record(self, 'play', replay=True)
             else:
-                # Loop to skip songs flagged as 'removed'
-                while not song:
-                    if self.queue.empty():
-                        if self.loop_type == 'queue' and self.history:
-                            # Refill queue from history for looping
-                            for track in self.history:
-                                await self.queue.put(track)
-                                async with self.lock:
-                                    self.queue_list.append(track)
-                            continue
-                        else:
-                            break  # no more songs
-
-                    candidate = await self.queue.get()
-                    # Keep queue_list in sync
-                    async with self.lock:
-                        if self.queue_list and self.queue_list[0] is candidate:
-                            self.queue_list.pop(0)
-                    if not candidate.get('removed'):
-                        song = candidate
-                        self.history.append(song)
+                if not self.queue and self.loop_type == 'queue' and self.history:
+                    # Refill queue from history for looping; replaying them refills history
+                    tracks = list(self.history)
+                    self.history.clear()
+                    queue_store.record(self, 'rewind')
+                    self.queue.extend(tracks)
+                track_id = self.queue.id_at(0) if self.queue else 0
+                song = self.queue.popleft()
+                if song:
+                    self.history.append(song)
+                    queue_store.record(self, 'play', track=song)
 
             if not song:
                 self.is_playing = False
                 self.playback_active = False
+                queue_store.record(self, 'idle')
+                return
+            # Set on tracks restored mid-play after a restart
+            resume_at, song.resume_at = song.resume_at, 0
+
+            trace = tracer.resume(song)
+            with trace_span('resolve'):
+                resolved = await self.resolve_song(song, track_id)
+            if not resolved:
+                notifier.send(ctx, f"ERROR Failed to download: {song.title}")
+                tracer.finish(trace, error="download failed")
+                self._advance()
                 return
 
             self.current_song = song
-            self.start_time = time.time()
+            self.start_time = time.time() - resume_at
             self.is_playing = True
             self.last_activity = time.time()
 
-            # Verify file exists
-            filepath = song['url']
-            if not os.path.exists(filepath):
-                bot_logger.error(f"File not found: {filepath}")
-                await ctx.send(f"ERROR File missing: {song['title']}")
-                # Try alternative extensions
-                base = os.path.splitext(filepath)[0]
-                for ext in SUPPORTED_AUDIO_EXTENSIONS:
-                    test_path = base + ext
-                    if os.path.exists(test_path):
-                        song['url'] = test_path
-                        break
-                else:
-                    self.playback_active = False
-                    asyncio.create_task(self._play_next_safe(ctx))
+            # Downloads record the file's path and size; only unchecked files (local, restored) are
+            # probed here, in the executor, and usually the prefetcher has done that already
+            download = downloader.progressive.get(song.url)
+            if not song.size and not download:
+                checked_at = time.time()
+                try:
+                    song.url, song.size = await asyncio.get_running_loop().run_in_executor(
+                        None, resolve_audio_file, song.url)
+                except FileNotFoundError:
+                    bot_logger.error(f"File not found: {song.url}")
+                    notifier.send(ctx, f"ERROR File missing: {song.title}")
+                    tracer.finish(trace, error="file missing")
+                    self._advance()
                     return
+                except Exception as e:
+                    bot_logger.error(f"File access error: {song.url} - {str(e)}")
+                    notifier.send(ctx, f"ERROR Cannot read file: {song.title}")
+                    tracer.finish(trace, error="file unreadable")
+                    self._advance()
+                    return
+                trace_spans([('file_check', checked_at, time.time())])
+
+            # Create audio source: replay pre-encoded frames if cached, otherwise run ffmpeg
+            # (recording the frames for next time unless the file is still downloading).
+            # Opening either touches the disk, so it runs in the executor too.
+            def open_source() -> Tuple[discord.AudioSource, str]:
+                # Partial plays neither use nor fill the frame cache
+                whole = not download and not resume_at
+                cached = frame_cache.open(song.url, song.size, self.guild_id) if whole else None
+                if cached is not None:
+                    return cached, 'frame_cache'
+                return TrackedFFmpegOpusAudio(
+                    song.url,
+                    guild_id=self.guild_id,
+                    opus=_is_opus(song),
+                    download=download,
+                    recorder=frame_cache.recorder(song.url, song.size) if whole else None,
+                    start_at=resume_at
+                ), 'ffmpeg'
 
-            # Verify file readable
-            try:
-                if os.path.getsize(song['url']) == 0:
-                    raise ValueError("Empty file")
-            except Exception as e:
-                bot_logger.error(f"File access error: {song['url']} - {str(e)}")
-                await ctx.send(f"ERROR Cannot read file: {song['title']}")
-                self.playback_active = False
-                asyncio.create_task(self._play_next_safe(ctx))
-                return
-
-            # Create audio source
             try:
-                source = TrackedFFmpegPCMAudio(song['url'], guild_id=self.guild_id)
+                with trace_span('source_spawn') as span:
+                    source, span['source'] = await asyncio.get_running_loop().run_in_executor(None, open_source)
             except Exception as e:
-                bot_logger.error(f"Failed to create audio source: {song['url']} - {str(e)}")
-                await ctx.send(f"ERROR Audio format error: {song['title']}")
-                self.playback_active = False
-                asyncio.create_task(self._play_next_safe(ctx))
+                bot_logger.error(f"Failed to create audio source: {song.url} - {str(e)}")
+                notifier.send(ctx, f"ERROR Audio format error: {song.title}")
+                tracer.finish(trace, error="audio source failed")
+                self._advance()
                 return
 
-            def after_playback(error):
-                self.playback_active = False
-                self.is_playing = False
-                if error:
-                    bot_logger.error(f"Playback error in guild {self.guild_id}: {error}")
-                asyncio.run_coroutine_threadsafe(self._play_next_safe(ctx), bot.loop)
+            if trace:
+                played_at = time.time()
 
-            try:
-                ctx.voice_client.play(source, after=after_playback)
-                await ctx.send(f"Now Playing: **{song['title']}**")
-            except discord.ClientException as e:
-                if "Already playing audio" in str(e):
-                    bot_logger.warning(f"Playback race condition in guild {self.guild_id}, retrying")
-                    self.playback_active = False
-                    await asyncio.sleep(1)
-                    asyncio.create_task(self._play_next_safe(ctx))
-                    return
-                else:
-                    raise
-        except Exception as e:
-            self.playback_active = False
-            bot_logger.error(f"Playback error in guild {self.guild_id}: {traceback.format_exc()}")
-            await ctx.send("ERROR Playback error occurred")
+                def first_packet():
+                    # Runs on the voice thread when the first frame goes out
+                    trace.add_span('first_packet', played_at, time.time())
+                    bot.loop.call_soon_threadsafe(tracer.finish, trace)
+                source.on_start = first_packet
 
             def after_playback(error):
-                self.playback_active = False
-                self.is_playing = False
+                # Runs on the voice thread; hand the track-finished event to the loop
                 if error:
                     bot_logger.error(f"Playback error in guild {self.guild_id}: {error}")
-                asyncio.run_coroutine_threadsafe(self._play_next_safe(ctx), bot.loop)
+                bot.loop.call_soon_threadsafe(self._advance)
 
             try:
                 ctx.voice_client.play(source, after=after_playback)
-                await ctx.send(f"Now Playing: **{song['title']}**")
+                self.schedule_prefetch()
+                notifier.send(ctx, f"Now Playing: **{song.title}**")
             except discord.ClientException as e:
                 if "Already playing audio" in str(e):
-                    bot_logger.warning(f"Playback race condition in guild {self.guild_id}, retrying")
+                    # Something else holds the voice client; its after-callback wakes us again
+                    bot_logger.warning(f"Voice client busy in guild {self.guild_id}, waiting for it to finish")
                     self.playback_active = False
-                    await asyncio.sleep(1)
-                    asyncio.create_task(self._play_next_safe(ctx))
                     return
                 else:
                     raise
         except Exception as e:
             self.playback_active = False
+            if not (ctx.voice_client and ctx.voice_client.is_playing()):
+                self.is_playing = False
+                # No after-callback will wake the loop; retry shortly so queued tracks don't stall
+                asyncio.get_running_loop().call_later(self.RETRY_DELAY, self.wake.set)
             bot_logger.error(f"Playback error in guild {self.guild_id}: {traceback.format_exc()}")
-            await ctx.send("ERROR Playback error occurred")
+            notifier.send(ctx, "ERROR Playback error occurred")
 
 guild_states: Dict[int, GuildState] = {}
 
 def get_guild_state(guild_id: int) -> GuildState:
     """Thread-safe guild state retrieval."""
     if guild_id not in guild_states:
-        guild_states[guild_id] = GuildState(guild_id)
+        state = guild_states[guild_id] = GuildState(guild_id)
+        queue_store.attach(state)
     return guild_states[guild_id]
 
+
+def _approx_size(obj: Any, depth: int = 3) -> int:
+    """Rough deep size of track dicts and lists, for the admin memory view."""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        size += sum(_approx_size(k, depth - 1) + _approx_size(v, depth - 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, deque)):
+        size += sum(_approx_size(item, depth - 1) for item in obj)
+    elif isinstance(obj, Track):
+        size += sum(_approx_size(getattr(obj, name), depth - 1) for name in Track.__slots__ if name != 'trace')
+    return size
+
+
+def guild_memory(state: GuildState) -> Dict[str, int]:
+    """Approximate bytes held by a guild's queue and history."""
+    return {
+        'queue': state.queue.approx_bytes(),
+        'history': _approx_size(state.history),
+    }
+
+
+async def evict_guild(state: GuildState) -> bool:
+    """Drop an idle guild from memory, spilling its queue to the queue store first."""
+    if not queue_store.spill(state):
+        return False
+    state.cancel_prefetch()
+    await state.stop_playback_loop()
+    guild_states.pop(state.guild_id, None)
+    last_join_channels.pop(state.guild_id, None)
+    metrics.stream_bytes.discard(state.guild_id)
+    metrics.frames_sent.discard(state.guild_id)
+    return True
+
+
+async def reap_idle_guilds() -> None:
+    """Disconnect voice clients idle for IDLE_DISCONNECT and unload guilds idle for GUILD_STATE_TTL."""
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        now = time.time()
+        try:
+            for vc in list(bot.voice_clients):
+                state = guild_states.get(vc.guild.id)
+                if (IDLE_DISCONNECT and state and not vc.is_playing()
+                        and now - state.last_activity > IDLE_DISCONNECT):
+                    bot_logger.info(f"Leaving idle voice channel in guild {state.guild_id}")
+                    await state.stop_playback_loop()
+                    state.cancel_prefetch()
+                    await vc.disconnect()
+                    # Restart the eviction clock from the disconnect
+                    state.last_activity = now
+
+            if not GUILD_STATE_TTL:
+                continue
+            evicted = 0
+            for state in list(guild_states.values()):
+                guild = bot.get_guild(state.guild_id)
+                if (now - state.last_activity > GUILD_STATE_TTL and not state.is_playing and state.loaded.is_set()
+                        and not (guild and guild.voice_client) and await evict_guild(state)):
+                    evicted += 1
+            if evicted:
+                bot_logger.info(f"Unloaded {evicted} idle guilds ({len(guild_states)} still loaded)")
+        except Exception as e:
+            bot_logger.error(f"Idle reaper error: {traceback.format_exc()}")
+
+# ==================== Progressive Downloads ====================
+class ProgressiveDownload:
+    """A track that is still being written to disk by yt-dlp while it plays."""
+
+    def __init__(self, path: str, loop: asyncio.AbstractEventLoop):
+        self.path = path
+        self.loop = loop
+        self.ready: asyncio.Future = loop.create_future()
+        self.finished = threading.Event()
+        self.error: Optional[BaseException] = None
+        self._ready_signalled = False
+
+    def progress_hook(self, d: Dict[str, Any]) -> None:
+        """yt-dlp progress hook, called from the download thread."""
+        if d.get('status') == 'downloading' and (d.get('downloaded_bytes') or 0) >= PROGRESSIVE_MIN_BYTES:
+            self._signal_ready()
+
+    async def watch_file(self) -> None:
+        """Poll the file size for readiness when progress hooks are unavailable (process pool)."""
+        while not self.ready.done():
+            try:
+                if os.path.getsize(self.path) >= PROGRESSIVE_MIN_BYTES:
+                    self._signal_ready()
+                    return
+            except OSError:
+                pass
+            await asyncio.sleep(0.1)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Mark the download as complete (or failed); safe to call from any thread."""
+        self.error = error
+        self.finished.set()
+        self._signal_ready()
+
+    def _signal_ready(self) -> None:
+        if self._ready_signalled:
+            return
+        self._ready_signalled = True
+        self.loop.call_soon_threadsafe(self._resolve_ready)
+
+    def _resolve_ready(self) -> None:
+        if not self.ready.done():
+            self.ready.set_result(self.error is None)
+
+
+class GrowingFileReader:
+    """File-like object that follows a file while it is being downloaded.
+
+    Used as a pipe source for ffmpeg: reads block until more bytes arrive and
+    only report EOF once the download has finished.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, download: ProgressiveDownload):
+        self.download = download
+        self._file = open(download.path, 'rb')
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            data = self._file.read(size)
+            if data:
+                return data
+            if self.download.finished.is_set():
+                # Pick up anything written between the last read and completion
+                data = self._file.read(size)
+                if not data:
+                    self._file.close()
+                return data
+            self.download.finished.wait(self.POLL_INTERVAL)
+
+    def close(self) -> None:
+        self._file.close()
+
 # ==================== Audio Source with Tracking ====================
-class TrackedFFmpegPCMAudio(discord.FFmpegPCMAudio):
-    def __init__(self, source, guild_id, **kwargs):
+def resolve_audio_file(path: str) -> Tuple[str, int]:
+    """Path and size of the file behind a track; blocking, so keep it off the event loop.
+
+    Tries the other audio extensions when the file is missing, since
+    post-processors may have changed it. Raises FileNotFoundError, or
+    ValueError for an empty file.
+    """
+    candidates = [path] + [os.path.splitext(path)[0] + ext for ext in SUPPORTED_AUDIO_EXTENSIONS]
+    for candidate in candidates:
+        try:
+            size = os.path.getsize(candidate)
+        except FileNotFoundError:
+            continue
+        if not size:
+            raise ValueError("Empty file")
+        return candidate, size
+    raise FileNotFoundError(path)
+
+
+def _local_file_size(path: str) -> int:
+    """Size of a regular file, or 0 if it is missing or unreadable; blocking."""
+    try:
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    except OSError:
+        return 0
+
+
+def _is_opus(song: Track) -> bool:
+    """Whether a track's file already holds an Opus stream that can be passed through."""
+    codec = (song.acodec or '').split('.')[0]
+    return codec == 'opus' or song.url.lower().endswith('.opus')
+
+
+class TrackedFFmpegOpusAudio(discord.FFmpegOpusAudio):
+    """Opus audio source that counts streamed bytes per guild.
+
+    Opus files are remuxed straight through (codec copy); anything else is
+    encoded to Opus by ffmpeg, so discord.py never encodes PCM in Python.
+    """
+
+    def __init__(self, source, guild_id, opus: bool = False,
+                 download: Optional[ProgressiveDownload] = None,
+                 recorder: Optional['FrameRecorder'] = None, start_at: float = 0, **kwargs):
+        # A track that is still downloading is fed to ffmpeg through stdin
+        if download and not download.finished.is_set():
+            source = GrowingFileReader(download)
+            kwargs['pipe'] = True
+        if start_at:
+            kwargs['before_options'] = f"-ss {start_at:.1f}"
         super().__init__(
             source,
+            bitrate=OPUS_BITRATE,
+            # discord.py stream-copies only for 'opus'/'libopus'; anything else is re-encoded with libopus
+            codec='opus' if opus else None,
             executable=FFMPEG_PATH,
-            options="-loglevel warning -analyzeduration 0 -bufsize 2048k",
+            options="-bufsize 2048k",
             **kwargs
         )
         self.guild_id = guild_id
+        self.recorder = recorder
+        self.on_start = None
+        self._counted = True
+        metrics.ffmpeg_processes.add('running')
 
     def read(self):
         data = super().read()
         if data:
-            DATA_USAGE[self.guild_id]['total_bytes'] += len(data)
+            if self.on_start:
+                self.on_start, on_start = None, self.on_start
+                on_start()
+            metrics.count_audio(self.guild_id, len(data))
+            if self.recorder:
+                self.recorder.write(data)
+        elif self.recorder:
+            # Played to the end: the recorded frames are a complete copy of the track,
+            # but only if ffmpeg actually succeeded
+            try:
+                returncode = self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                returncode = None
+            if returncode == 0:
+                self.recorder.commit()
+            else:
+                bot_logger.warning(f"Not caching frames for guild {self.guild_id}: ffmpeg exited with {returncode}")
+                self.recorder.abort()
+        return data
+
+    def cleanup(self):
+        super().cleanup()
+        if self._counted:
+            self._counted = False
+            metrics.ffmpeg_processes.add('running', -1)
+        if self.recorder:
+            self.recorder.abort()
+
+
+class CachedOpusAudio(discord.AudioSource):
+    """Replays pre-encoded Opus packets from a memory-mapped frame cache file."""
+
+    def __init__(self, path: str, guild_id: int):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(FrameCache.MAGIC)] != FrameCache.MAGIC:
+            self._map.close()
+            raise ValueError(f"Not a frame cache file: {path}")
+        if len(self._map) <= len(FrameCache.MAGIC) + 2:
+            self._map.close()
+            raise ValueError(f"Frame cache file has no frames: {path}")
+        self._pos = len(FrameCache.MAGIC)
+        self.guild_id = guild_id
+        self.on_start = None
+
+    def read(self) -> bytes:
+        frames, pos = self._map, self._pos
+        if frames is None or pos + 2 > len(frames):
+            return b''
+        (length,) = struct.unpack_from('<H', frames, pos)
+        data = frames[pos + 2:pos + 2 + length]
+        if len(data) < length:
+            return b''
+        self._pos = pos + 2 + length
+        if self.on_start:
+            self.on_start, on_start = None, self.on_start
+            on_start()
+        metrics.count_audio(self.guild_id, len(data))
         return data
 
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+# ==================== Opus Frame Cache ====================
+class FrameRecorder:
+    """Writes the Opus packets of a track as it plays; committed only if it plays to the end."""
+
+    def __init__(self, cache: 'FrameCache', key: str):
+        self.cache = cache
+        self.key = key
+        self.tmp_path = f"{cache.path_for(key)}.{os.getpid()}.{id(self)}.tmp"
+        self._file = open(self.tmp_path, 'wb')
+        self._file.write(FrameCache.MAGIC)
+        self.size = len(FrameCache.MAGIC)
+        self.packets = 0
+        self.done = False
+
+    def write(self, packet: bytes) -> None:
+        if self.done:
+            return
+        self._file.write(struct.pack('<H', len(packet)))
+        self._file.write(packet)
+        self.size += 2 + len(packet)
+        self.packets += 1
+
+    def commit(self) -> None:
+        if self.done:
+            return
+        if not self.packets:
+            self.abort()
+            return
+        self.done = True
+        self._file.close()
+        self.cache.add(self.key, self.tmp_path, self.size)
+
+    def abort(self) -> None:
+        if self.done:
+            return
+        self.done = True
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class FrameCache:
+    """Size-bounded on-disk cache of pre-encoded Opus packets, keyed by source file.
+
+    Each .opf file is MAGIC followed by length-prefixed packets (2-byte
+    little-endian length, then the packet). Repeat plays read them through a
+    memory map instead of spawning ffmpeg. Least recently used files are
+    evicted once the cache exceeds its budget.
+    """
+
+    MAGIC = b'FTOPUS1\n'
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._total = 0
+        if max_bytes > 0:
+            os.makedirs(root, exist_ok=True)
+
+    def scan(self) -> int:
+        """Index files left by earlier runs; done in the background after start-up.
+
+        Entries adopted by _known() in the meantime keep their (more recent) place.
+        """
+        if self.max_bytes <= 0:
+            return 0
+        found = []
+        for entry in os.scandir(self.root):
+            stat = entry.stat()
+            if entry.name.endswith('.tmp'):
+                # Leftovers from a crash; recent ones may belong to another running process
+                if stat.st_mtime < time.time() - 3600:
+                    os.remove(entry.path)
+            elif entry.name.endswith('.opf'):
+                found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        with self._lock:
+            seen = OrderedDict((key, size) for _, key, size in sorted(found) if key not in self._entries)
+            seen.update(self._entries)
+            self._entries = seen
+            self._total = sum(seen.values())
+        return len(found)
+
+    @staticmethod
+    def key_for(path: str, size: int) -> str:
+        return hashlib.sha1(f"{os.path.abspath(path)}|{size}".encode('utf-8')).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, key + '.opf')
+
+    def open(self, path: str, size: int, guild_id: int) -> Optional[CachedOpusAudio]:
+        """Audio source for a cached track, or None if it has not been recorded yet."""
+        key = self.key_for(path, size)
+        if not self._known(key):
+            return None
+        try:
+            source = CachedOpusAudio(self.path_for(key), guild_id)
+        except (OSError, ValueError) as e:
+            bot_logger.warning(f"Dropping unreadable frame cache entry {key}: {str(e)}")
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+            try:
+                # Otherwise _known() would adopt it again on the next play
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+            return None
+        try:
+            # Persist recency across restarts
+            os.utime(self.path_for(key))
+        except OSError:
+            pass
+        return source
+
+    def recorder(self, path: str, size: int) -> Optional[FrameRecorder]:
+        if self.max_bytes <= 0:
+            return None
+        key = self.key_for(path, size)
+        if self._known(key):
+            return None
+        try:
+            return FrameRecorder(self, key)
+        except OSError as e:
+            bot_logger.warning(f"Cannot record frames for {path}: {str(e)}")
+            return None
+
+    def _known(self, key: str) -> bool:
+        """Whether a track is cached, adopting files recorded by other shard processes."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+        try:
+            size = os.path.getsize(self.path_for(key))
+        except OSError:
+            return False
+        with self._lock:
+            self._total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+        return True
+
+    def add(self, key: str, tmp_path: str, size: int) -> None:
+        os.replace(tmp_path, self.path_for(key))
+        with self._lock:
+            self._total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                try:
+                    os.remove(self.path_for(old_key))
+                except OSError:
+                    pass
+
+# ==================== Outbound Message Coalescing ====================
+class _Outbox:
+    """Messages waiting to go out to one channel."""
+
+    def __init__(self):
+        self.sends: List[Tuple[Any, str]] = []
+        self.warn_target: Any = None
+        self.warnings: List[str] = []
+        self.edits: Dict[int, Tuple[Any, str]] = {}
+
+
+class MessageCoalescer:
+    """Per-channel outbound message coalescer.
+
+    Callers queue sends, edits and warnings and return immediately. Every
+    `window` seconds a background task per channel delivers them: consecutive
+    sends are joined, only the latest content of each edited message is sent,
+    and warnings collapse into one summary. Discord rate-limit waits therefore
+    land on the flusher, never on the command or the player.
+    """
+
+    MAX_LENGTH = 1900
+    MAX_WARNING_LINES = 10
+
+    def __init__(self, window: float):
+        self.window = window
+        self._outboxes: Dict[Any, _Outbox] = {}
+        self._flushers: Dict[Any, asyncio.Task] = {}
+
+    @staticmethod
+    def _channel_key(target: Any) -> Any:
+        channel = getattr(target, 'channel', None)
+        return getattr(channel, 'id', None) or id(target)
+
+    def _outbox(self, key: Any) -> _Outbox:
+        outbox = self._outboxes.get(key)
+        if outbox is None:
+            outbox = self._outboxes[key] = _Outbox()
+        if key not in self._flushers:
+            self._flushers[key] = asyncio.create_task(self._flush_loop(key))
+        return outbox
+
+    def send(self, target: Any, content: str) -> None:
+        """Queue a message to `target` (anything with an async send, e.g. a ctx)."""
+        self._outbox(self._channel_key(target)).sends.append((target, content))
+
+    def edit(self, message: Any, content: str) -> None:
+        """Queue an edit; if several land in one window only the last is sent."""
+        if message is None:
+            return
+        self._outbox(self._channel_key(message)).edits[message.id] = (message, content)
+
+    def warn(self, target: Any, text: str) -> None:
+        """Queue a warning to be reported in the channel's next summary message."""
+        outbox = self._outbox(self._channel_key(target))
+        outbox.warn_target = target
+        outbox.warnings.append(text)
+
+    async def _flush_loop(self, key: Any) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.window)
+                outbox = self._outboxes.pop(key, None)
+                if outbox is None:
+                    break
+                await self._deliver(outbox)
+        finally:
+            self._flushers.pop(key, None)
+
+    async def _deliver(self, outbox: _Outbox) -> None:
+        # Join consecutive sends to the same target while they fit in one message
+        batches: List[Tuple[Any, List[str]]] = []
+        for target, content in outbox.sends:
+            if (batches and batches[-1][0] is target
+                    and sum(len(c) + 1 for c in batches[-1][1]) + len(content) <= self.MAX_LENGTH):
+                batches[-1][1].append(content)
+            else:
+                batches.append((target, [content]))
+        for target, contents in batches:
+            await self._safely(target.send("\n".join(contents)))
+
+        if outbox.warnings:
+            shown = outbox.warnings[:self.MAX_WARNING_LINES]
+            lines = [f"Warning: {len(outbox.warnings)} issue(s):"] + [f"- {w}" for w in shown]
+            if len(outbox.warnings) > len(shown):
+                lines.append(f"...and {len(outbox.warnings) - len(shown)} more")
+            await self._safely(outbox.warn_target.send("\n".join(lines)[:self.MAX_LENGTH]))
+
+        for message, content in outbox.edits.values():
+            await self._safely(message.edit(content=content))
+
+    @staticmethod
+    async def _safely(coro) -> None:
+        try:
+            await coro
+        except Exception as e:
+            bot_logger.warning(f"Failed to deliver message: {str(e)}")
+
+
+notifier = MessageCoalescer(MESSAGE_COALESCE_WINDOW)
+
 # ==================== Mock Context for CLI ====================
+class _CliReply:
+    """Output of one command sent by the shard supervisor."""
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.open = True
+
+
+# Set per supervisor request; tasks a command starts inherit it, but print to stdout once it is answered
+cli_reply: ContextVar[Optional[_CliReply]] = ContextVar('cli_reply', default=None)
+
+
+def _print(*args, **kwargs) -> None:
+    """print() for CLI output: goes into the supervisor's reply while answering its command."""
+    reply = cli_reply.get()
+    if reply is not None and reply.open:
+        kwargs['file'] = reply.buffer
+    print(*args, **kwargs)
+
+
 class MockContext:
     def __init__(self, guild: discord.Guild, channel: Optional[discord.TextChannel] = None):
         self.guild = guild
@@ -318,24 +2259,906 @@ class MockContext:
             'content': ''
         })()
 
-    async def send(self, content):
+    async def send(self, content, **kwargs):
         if self.channel:
             try:
-                await self.channel.send(content)
+                return await self.channel.send(content, **kwargs)
             except Exception as e:
-                print(f"[Bot Error] Failed to send message: {e}")
+                _print(f"[Bot Error] Failed to send message: {e}")
         else:
-            print(f"[Bot] {content}")
+            _print(f"[Bot] {content}")
+
+# ==================== Track Cache ====================
+def _cache_key_for_info(info: Dict[str, Any]) -> Optional[str]:
+    """Cache key for a resolved (or flat playlist) yt-dlp info dict."""
+    extractor = info.get('extractor_key') or info.get('ie_key')
+    video_id = info.get('id')
+    if not extractor or not video_id:
+        return None
+    return f"{extractor}:{video_id}"
+
+
+_extractor_classes: List[Any] = []
+_extractor_lock = threading.Lock()
+
+def _cache_key_for_url(url: str) -> Optional[str]:
+    """Derive the cache key for a URL from the extractor URL patterns, without network access.
+
+    Blocking (the first call imports yt-dlp, and matching scans its extractors), so keep it off the event loop.
+    """
+    if not _extractor_classes:
+        with _extractor_lock:
+            if not _extractor_classes:
+                # YouTube first: it serves almost every request and saves matching ~1800 patterns
+                youtube = youtube_dl.extractor.get_info_extractor('Youtube')
+                _extractor_classes[:] = [youtube, *(
+                    ie for ie in youtube_dl.extractor.gen_extractor_classes()
+                    if ie is not youtube and ie.ie_key() != 'Generic'
+                )]
+    for ie in _extractor_classes:
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{video_id}" if video_id else None
+    return None
+
+
+class TrackCache:
+    """Persistent on-disk track cache keyed by extractor and video ID, with LRU eviction.
+
+    Files live in TRACK_CACHE_DIR/<extractor>/<id>.<ext>; an SQLite index records
+    size, last access and hit count so the disk budget can be enforced across restarts.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        # Shared by every shard process; the timeout waits out their write locks
+        self._db = sqlite3.connect(os.path.join(root, 'index.sqlite3'), timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            ' path TEXT NOT NULL, owner TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (path, owner))'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS tracks ('
+            ' key TEXT PRIMARY KEY, path TEXT NOT NULL, title TEXT, webpage_url TEXT,'
+            ' duration REAL, size INTEGER NOT NULL, last_access REAL NOT NULL,'
+            ' hits INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS tracks_last_access ON tracks(last_access)')
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(tracks)')}
+        if 'acodec' not in columns:
+            self._db.execute('ALTER TABLE tracks ADD COLUMN acodec TEXT')
+
+    def get(self, key: str) -> Optional[Track]:
+        """Return the cached track, with its file size checked, and record the hit; None on a miss.
+
+        Blocking (SQLite and a stat); call from an executor.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT path, title, webpage_url, duration, acodec FROM tracks WHERE key = ?', (key,)
+            ).fetchone()
+            if not row:
+                return None
+            path, title, webpage_url, duration, acodec = row
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            if not size:
+                self._db.execute('DELETE FROM tracks WHERE key = ?', (key,))
+                return None
+            self._db.execute(
+                'UPDATE tracks SET last_access = ?, hits = hits + 1 WHERE key = ?', (time.time(), key)
+            )
+        return Track(title, path, webpage_url, duration, acodec=acodec, size=size)
+
+    def put(self, key: str, song: Track) -> None:
+        """Index a completed download and evict old entries if over budget."""
+        try:
+            size = os.path.getsize(song.url)
+        except OSError:
+            return
+        # Progressive downloads only learn their final size here
+        song.size = size
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO tracks (key, path, title, webpage_url, duration, acodec, size, last_access)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT(key) DO UPDATE SET path = excluded.path, title = excluded.title,'
+                ' webpage_url = excluded.webpage_url, duration = excluded.duration,'
+                ' acodec = excluded.acodec, size = excluded.size, last_access = excluded.last_access',
+                (key, song.url, song.title, song.webpage_url, song.duration, song.acodec, size, time.time())
+            )
+        self.evict()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, total, hits = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM tracks'
+            ).fetchone()
+        return {'entries': count, 'bytes': total, 'hits': hits}
+
+    def lease(self, paths: set, ttl: float) -> None:
+        """Publish the files this process is using so other shard processes don't evict them."""
+        owner = str(os.getpid())
+        expires = time.time() + ttl
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM leases WHERE owner = ? OR expires < ?', (owner, time.time()))
+                self._db.executemany('INSERT OR REPLACE INTO leases (path, owner, expires) VALUES (?, ?, ?)',
+                                     [(path, owner, expires) for path in paths])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def evict(self) -> int:
+        """Delete least recently used tracks until the cache fits its budget. Returns bytes freed."""
+        freed = 0
+        with self._lock:
+            total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM tracks').fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            protected = _paths_in_use()
+            protected.update(row[0] for row in self._db.execute(
+                'SELECT path FROM leases WHERE expires >= ?', (time.time(),)
+            ))
+            for key, path, size in self._db.execute(
+                'SELECT key, path, size FROM tracks ORDER BY last_access'
+            ).fetchall():
+                if total - freed <= self.max_bytes:
+                    break
+                if path in protected:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    bot_logger.warning(f"Could not evict cached track {path}: {str(e)}")
+                    continue
+                self._db.execute('DELETE FROM tracks WHERE key = ?', (key,))
+                freed += size
+        if freed:
+            bot_logger.info(f"Evicted {freed / 1024 / 1024:.1f} MB from track cache")
+        return freed
+
+
+def _paths_in_use() -> set:
+    """Files referenced by any guild's queue, current song or in-flight download."""
+    paths = set(downloader.progressive)
+    for state in list(guild_states.values()):
+        songs = state.queue.snapshot()
+        if state.current_song:
+            songs.append(state.current_song)
+        if state.loop_type == 'queue':
+            songs.extend(state.history)
+        paths.update(song.url for song in songs)
+    return paths
+
+# ==================== Metadata Cache ====================
+class MetadataCache:
+    """Two-tier cache for extract_info results: an in-memory LRU in front of SQLite.
+
+    Entries expire after a TTL chosen by result kind (search, video, playlist).
+    The hot tier holds serialized JSON so callers always get a private copy.
+    """
+
+    TTLS = {
+        'search': METADATA_TTL_SEARCH,
+        'video': METADATA_TTL_VIDEO,
+        'playlist': METADATA_TTL_PLAYLIST,
+    }
+
+    def __init__(self, path: str, hot_entries: int):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.hot_entries = hot_entries
+        self._hot: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            ' key TEXT PRIMARY KEY, kind TEXT NOT NULL, expires REAL NOT NULL, info TEXT NOT NULL)'
+        )
+
+    def purge_expired(self) -> int:
+        """Drop expired rows; run off the event loop after start-up."""
+        with self._lock:
+            return self._db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),)).rowcount
+
+    @staticmethod
+    def kind_of(url: str, info: Dict[str, Any]) -> str:
+        if url.startswith('ytsearch'):
+            return 'search'
+        if info.get('_type') == 'playlist':
+            return 'playlist'
+        return 'video'
+
+    def get_hot(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up the in-memory tier only; safe to call on the event loop."""
+        with self._lock:
+            entry = self._hot.get(key)
+            if entry is None:
+                return None
+            expires, text = entry
+            if expires < time.time():
+                del self._hot[key]
+                return None
+            self._hot.move_to_end(key)
+        return json.loads(text)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up both tiers, promoting SQLite hits into memory."""
+        info = self.get_hot(key)
+        if info is not None:
+            return info
+        with self._lock:
+            row = self._db.execute(
+                'SELECT expires, info FROM metadata WHERE key = ? AND expires >= ?', (key, time.time())
+            ).fetchone()
+            if not row:
+                return None
+            self._remember(key, row[0], row[1])
+        return json.loads(row[1])
+
+    def put(self, key: str, kind: str, info: Dict[str, Any]) -> None:
+        text = json.dumps(info)
+        expires = time.time() + self.TTLS[kind]
+        with self._lock:
+            self._remember(key, expires, text)
+            self._db.execute(
+                'INSERT OR REPLACE INTO metadata (key, kind, expires, info) VALUES (?, ?, ?, ?)',
+                (key, kind, expires, text)
+            )
+
+    def _remember(self, key: str, expires: float, text: str) -> None:
+        self._hot[key] = (expires, text)
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_entries:
+            self._hot.popitem(last=False)
+
+# ==================== Local Library ====================
+@dataclass
+class LibraryEntry:
+    path: str
+    title: str
+    artist: str
+    album: str
+    duration: int
+    size: int
+
+    @property
+    def display_title(self) -> str:
+        return f"{self.artist} - {self.title}" if self.artist else self.title
+
+    def track(self, requester: Optional[str] = None) -> Track:
+        # Size comes from the scan, so the player needs no filesystem probe
+        return Track(self.display_title, self.path, duration=self.duration, requester=requester, size=self.size)
+
+
+def _search_tokens(text: str) -> List[str]:
+    """Lower-case words with accents stripped, so 'Beyoncé' matches 'beyonce'."""
+    text = unicodedata.normalize('NFKD', text.lower().replace("'", "").replace("\u2019", ""))
+    return re.findall(r'\w+', ''.join(ch for ch in text if not unicodedata.combining(ch)))
+
+
+def _probe_tags(path: str) -> Dict[str, Any]:
+    """Title, artist, album and duration of an audio file via ffprobe; runs on the scan pool."""
+    tags: Dict[str, str] = {}
+    duration = 0
+    try:
+        result = subprocess.run(
+            [FFPROBE_PATH, '-v', 'error', '-of', 'json', '-show_entries',
+             'format=duration:format_tags=title,artist,album:stream_tags=title,artist,album', path],
+            capture_output=True, check=True, timeout=30
+        )
+        data = json.loads(result.stdout or b'{}')
+        fmt = data.get('format', {})
+        duration = int(float(fmt.get('duration') or 0))
+        # Ogg/Opus keep tags on the stream rather than the container
+        for source in [stream.get('tags', {}) for stream in data.get('streams', [])] + [fmt.get('tags', {})]:
+            tags.update({key.lower(): value for key, value in source.items() if value})
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        bot_logger.warning(f"Could not read tags from {path}: {str(e)}")
+    return {
+        'title': tags.get('title') or os.path.splitext(os.path.basename(path))[0],
+        'artist': tags.get('artist', ''),
+        'album': tags.get('album', ''),
+        'duration': duration,
+    }
+
+
+class Library:
+    """Index of local audio files under LIBRARY_DIRS, searchable by title, artist and album.
+
+    Tags and durations come from ffprobe on a worker pool and are kept in
+    SQLite; rescans only probe files whose mtime or size changed. Searches run
+    against an in-memory token index rebuilt after each scan: every query word
+    must match a token by prefix, or by spelling for longer words.
+    """
+    MAX_PREFIX_TOKENS = 64
+    COMMIT_EVERY = 500
+
+    def __init__(self, roots: List[str], path: str, workers: int):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.workers = max(1, workers)
+        self.enabled = bool(roots)
+        self.last_scan: Dict[str, Any] = {}
+        self._rescan = asyncio.Event()
+        # (entries, token -> entry indexes, sorted tokens, path -> entry), swapped whole after a rebuild
+        self._index: Tuple[List[LibraryEntry], Dict[str, List[int]], List[str], Dict[str, LibraryEntry]] = ([], {}, [], {})
+        self._db = None
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL,'
+            ' title TEXT NOT NULL, artist TEXT NOT NULL, album TEXT NOT NULL, duration INTEGER NOT NULL)'
+        )
+
+    def __len__(self) -> int:
+        return len(self._index[0])
+
+    # ----- Scanning (blocking; runs in the executor) -----
+    def scan(self) -> Dict[str, Any]:
+        """Bring the index up to date with the library directories."""
+        started = time.time()
+        known = {path: (mtime_ns, size) for path, mtime_ns, size in
+                 self._db.execute('SELECT path, mtime_ns, size FROM files')}
+        seen = set()
+        changed = []
+        for root in self.roots:
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    if os.path.splitext(name)[1].lower() not in SUPPORTED_AUDIO_EXTENSIONS:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if not stat.st_size:
+                        continue
+                    seen.add(path)
+                    if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                        changed.append((path, stat.st_mtime_ns, stat.st_size))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='library-scan') as pool:
+            for done, ((path, mtime_ns, size), tags) in enumerate(
+                    zip(changed, pool.map(_probe_tags, [path for path, _, _ in changed])), 1):
+                self._db.execute(
+                    'INSERT OR REPLACE INTO files (path, mtime_ns, size, title, artist, album, duration)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (path, mtime_ns, size, tags['title'], tags['artist'], tags['album'], tags['duration'])
+                )
+                if done % self.COMMIT_EVERY == 0:
+                    self._db.commit()
+        removed = known.keys() - seen
+        self._db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+        self._db.commit()
+        self.load()
+        self.last_scan = {'at': time.time(), 'seconds': time.time() - started, 'files': len(seen),
+                          'probed': len(changed), 'removed': len(removed)}
+        return self.last_scan
+
+    def load(self) -> None:
+        """Rebuild the in-memory search index from the database."""
+        entries = [LibraryEntry(*row) for row in self._db.execute(
+            'SELECT path, title, artist, album, duration, size FROM files ORDER BY artist, album, title')]
+        postings: Dict[str, List[int]] = defaultdict(list)
+        for i, entry in enumerate(entries):
+            words = _search_tokens(f"{entry.title} {entry.artist} {entry.album} "
+                                   f"{os.path.splitext(os.path.basename(entry.path))[0]}")
+            for token in dict.fromkeys(words):
+                postings[token].append(i)
+        self._index = (entries, dict(postings), sorted(postings), {entry.path: entry for entry in entries})
+
+    # ----- Lookups (in memory; fine on the event loop) -----
+    def _expand(self, word: str, tokens: List[str]) -> List[str]:
+        """Tokens that start with `word`, or close spellings of it when none do."""
+        start = bisect.bisect_left(tokens, word)
+        matches = []
+        for token in tokens[start:start + self.MAX_PREFIX_TOKENS]:
+            if not token.startswith(word):
+                break
+            matches.append(token)
+        if matches or len(word) < 4:
+            return matches
+        # Typo tolerance, among tokens sharing the first two letters
+        lo = bisect.bisect_left(tokens, word[:2])
+        hi = bisect.bisect_left(tokens, word[:2] + '\U0010ffff')
+        return difflib.get_close_matches(word, tokens[lo:hi], n=3, cutoff=0.8)
+
+    def search(self, query: str, limit: int = 5) -> List[LibraryEntry]:
+        entries, postings, tokens, _ = self._index
+        words = _search_tokens(query)
+        if not words or not entries:
+            return []
+        matched: Optional[set] = None
+        scores: Dict[int, int] = defaultdict(int)
+        # Rarest words first, so the candidate set shrinks quickly
+        for word in sorted(set(words), key=lambda w: len(postings.get(w, ())) or len(entries)):
+            hits = set()
+            for token in self._expand(word, tokens):
+                ids = postings[token] if matched is None else [i for i in postings[token] if i in matched]
+                hits.update(ids)
+                for i in ids:
+                    scores[i] += 2 if token == word else 1
+            matched = hits if matched is None else matched & hits
+            if not matched:
+                return []
+        ranked = sorted(matched, key=lambda i: (-scores[i], entries[i].display_title.lower()))
+        return [entries[i] for i in ranked[:limit]]
+
+    def entry_for(self, path: str) -> Optional[LibraryEntry]:
+        return self._index[3].get(os.path.abspath(path))
+
+    def track_for(self, path: str, requester: Optional[str] = None) -> Track:
+        """Track for a local file, with its tags if the library has indexed it."""
+        entry = self.entry_for(path)
+        if entry is not None:
+            return entry.track(requester)
+        return Track(os.path.basename(path), path, requester=requester)
+
+    # ----- Background task -----
+    def request_rescan(self) -> None:
+        self._rescan.set()
+
+    async def run(self) -> None:
+        """Scan at startup, then every LIBRARY_RESCAN_INTERVAL seconds or when asked to.
+
+        With shards, only the first process scans; the others reload the shared index.
+        """
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if SHARD_PROCESS == 0:
+                    stats = await loop.run_in_executor(None, self.scan)
+                    bot_logger.info(f"Library scan: {stats['files']} files, {stats['probed']} probed, "
+                                    f"{stats['removed']} removed in {stats['seconds']:.1f}s")
+                else:
+                    await loop.run_in_executor(None, self.load)
+            except Exception as e:
+                bot_logger.error(f"Library scan failed: {traceback.format_exc()}")
+            self._rescan.clear()
+            try:
+                await asyncio.wait_for(self._rescan.wait(), LIBRARY_RESCAN_INTERVAL or None)
+            except asyncio.TimeoutError:
+                pass
+
+
+library = Library([] if YDL_WORKER else LIBRARY_DIRS, os.path.join(CACHE_DIR, 'library.sqlite3'), LIBRARY_SCAN_WORKERS)
+
+
+def iter_playlist(path: str):
+    """Yield (path, title, duration) for each entry of an M3U/M3U8 or PLS playlist, reading as it goes.
+
+    Titles and durations come from #EXTINF lines (M3U) or TitleN/LengthN keys
+    (PLS) and are None/0 when absent. Relative paths are resolved against the
+    playlist's directory. Plain lists of paths, one per line, work as M3U.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+
+    def seconds(text: str) -> int:
+        text = text.strip()
+        return max(0, int(float(text))) if re.fullmatch(r'-?\d+(\.\d+)?', text) else 0
+
+    def resolve(entry: str) -> str:
+        entry = entry.strip()
+        if entry.startswith('file://'):
+            entry = urllib.request.url2pathname(entry[len('file://'):])
+        return entry if entry.startswith(('http://', 'https://')) else os.path.join(base, os.path.expanduser(entry))
+
+    with open(path, encoding='utf-8-sig', errors='replace') as f:
+        first = ''
+        for first in f:
+            if first.strip():
+                break
+        if first.strip().lower() == '[playlist]' or path.lower().endswith('.pls'):
+            # PLS: entry N is emitted once its FileN, TitleN and LengthN are all seen, or as soon
+            # as a key for another entry follows it (TitleN/LengthN are optional). Only entries
+            # still missing their FileN wait, in case it comes later, until the end of the file.
+            pending: Dict[int, Dict[str, str]] = {}
+            current = None
+
+            def entry(fields: Dict[str, str]) -> Tuple[str, Optional[str], int]:
+                return resolve(fields['file']), fields.get('title') or None, seconds(fields.get('length', ''))
+
+            lines = f if first.strip().lower() == '[playlist]' else itertools.chain([first], f)
+            for line in lines:
+                match = re.match(r'\s*(file|title|length)(\d+)\s*=(.*)', line, re.IGNORECASE)
+                if not match:
+                    continue
+                index = int(match.group(2))
+                if index != current and 'file' in pending.get(current, {}):
+                    yield entry(pending.pop(current))
+                current = index
+                fields = pending.setdefault(index, {})
+                fields[match.group(1).lower()] = match.group(3).strip()
+                if len(fields) == 3:
+                    yield entry(pending.pop(index))
+            for _, fields in sorted(pending.items()):
+                if 'file' in fields:
+                    yield entry(fields)
+            return
+
+        title, duration = None, 0
+        for line in itertools.chain([first], f):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                if line.upper().startswith('#EXTINF:'):
+                    # #EXTINF:<seconds> [attributes],<title>
+                    info, _, name = line[len('#EXTINF:'):].partition(',')
+                    duration = seconds(info.split()[0] if info.split() else '')
+                    title = name.strip() or None
+                continue
+            yield resolve(line), title, duration
+            title, duration = None, 0
+
+# ==================== Download Scheduler ====================
+class DownloadJob:
+    """One unit of yt-dlp work waiting for (or holding) a download slot."""
+
+    def __init__(self, guild_id: int, fn, args: tuple, cancelled: threading.Event,
+                 future: asyncio.Future):
+        self.guild_id = guild_id
+        self.fn = fn
+        self.args = args
+        self.cancelled = cancelled
+        self.future = future
+
+
+class DownloadScheduler:
+    """Global front end to the download executor (thread or process pool).
+
+    Caps concurrent yt-dlp jobs across all guilds, serves guilds round-robin so
+    one huge playlist cannot starve everyone else, and runs interactive
+    single-track requests ahead of bulk playlist prefetches. Cancelling a job's
+    future drops it from the queue, or flags a running job so its progress hook
+    aborts the download.
+    """
+
+    def __init__(self, executor: Executor, concurrency: int):
+        self.executor = executor
+        self.concurrency = concurrency
+        self._running = 0
+        # interactive lane first; each lane maps guild -> pending jobs, rotated round-robin
+        self._lanes: Tuple['OrderedDict[int, List[DownloadJob]]', ...] = (OrderedDict(), OrderedDict())
+        self._guild_jobs: Dict[int, set] = defaultdict(set)
+
+    @property
+    def pending(self) -> int:
+        return sum(len(jobs) for lane in self._lanes for jobs in lane.values())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def submit(self, fn, *args, guild_id: Optional[int] = None, interactive: bool = True,
+               cancelled: Optional[threading.Event] = None) -> asyncio.Future:
+        """Queue fn(*args) to run on the executor and return a future for its result."""
+        loop = asyncio.get_running_loop()
+        job = DownloadJob(guild_id or 0, fn, args, cancelled or threading.Event(), loop.create_future())
+        job.future.add_done_callback(lambda f: job.cancelled.set() if f.cancelled() else None)
+        self._lanes[0 if interactive else 1].setdefault(job.guild_id, []).append(job)
+        self._guild_jobs[job.guild_id].add(job)
+        self._dispatch()
+        return job.future
+
+    def cancel_guild(self, guild_id: int) -> int:
+        """Cancel every queued and running job for a guild (e.g. when it leaves voice)."""
+        jobs = self._guild_jobs.pop(guild_id, set())
+        for lane in self._lanes:
+            lane.pop(guild_id, None)
+        for job in jobs:
+            job.future.cancel()
+        if jobs:
+            bot_logger.info(f"Cancelled {len(jobs)} download jobs for guild {guild_id}")
+        return len(jobs)
+
+    def _next_job(self) -> Optional[DownloadJob]:
+        for lane in self._lanes:
+            while lane:
+                guild_id, jobs = next(iter(lane.items()))
+                job = jobs.pop(0)
+                if jobs:
+                    lane.move_to_end(guild_id)
+                else:
+                    del lane[guild_id]
+                if not job.future.done():
+                    return job
+                self._forget(job)
+        return None
+
+    def _dispatch(self) -> None:
+        while self._running < self.concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            self._running += 1
+            running = asyncio.get_running_loop().run_in_executor(self.executor, job.fn, *job.args)
+            running.add_done_callback(lambda f, job=job: self._finished(job, f))
+
+    def _finished(self, job: DownloadJob, running: asyncio.Future) -> None:
+        self._running -= 1
+        self._forget(job)
+        if not job.future.done():
+            if running.cancelled():
+                job.future.cancel()
+            elif running.exception() is not None:
+                job.future.set_exception(running.exception())
+            else:
+                job.future.set_result(running.result())
+        self._dispatch()
+
+    def _forget(self, job: DownloadJob) -> None:
+        jobs = self._guild_jobs.get(job.guild_id)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                del self._guild_jobs[job.guild_id]
+
+# ==================== yt-dlp Jobs ====================
+# Module-level so they can run on either the thread pool or, pickled, on the
+# process pool. They only take and return plain data.
+def _ydl_worker_init() -> None:
+    """Warm a download worker: pay the yt-dlp start-up cost before the first job."""
+    youtube_dl.YoutubeDL({'quiet': True, 'logger': yt_logger})
+
+
+def _ydl_extract(url: str, opts: Dict[str, Any], download: bool, process: bool) -> Optional[Dict[str, Any]]:
+    """Run extract_info and return a JSON-safe info dict."""
+    with youtube_dl.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=download, process=process)
+        if not info:
+            return None
+        # Unprocessed playlists yield entries lazily; resolve them here, off the event loop
+        if info.get('entries') is not None and not isinstance(info['entries'], list):
+            info['entries'] = list(info['entries'])
+        return ydl.sanitize_info(info)
+
+
+def _ydl_download(url: str, opts: Dict[str, Any]
+                  ) -> Optional[Tuple[Optional[str], Track, List[Tuple[str, float, float]]]]:
+    """Download a single track and return its cache key, song dict and timed stages."""
+    spans = []
+    pp_started = {}
+
+    def pp_hook(d):
+        if d['status'] == 'started':
+            pp_started[d['postprocessor']] = time.time()
+        elif d['status'] == 'finished' and d['postprocessor'] in pp_started:
+            spans.append((f"postprocess.{d['postprocessor']}", pp_started.pop(d['postprocessor']), time.time()))
+
+    opts = {**opts, 'postprocessor_hooks': [*opts.get('postprocessor_hooks', []), pp_hook]}
+    started = time.time()
+    with _download_lock(url), youtube_dl.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+        if not info:
+            return None
+        filepath = ydl.prepare_filename(info)
+    spans.insert(0, ('ydl_download', started, time.time()))
+
+    # Determine actual file path (post-processors may have changed the extension)
+    probed_at = time.time()
+    filepath, size = resolve_audio_file(filepath)
+    spans.append(('probe_filename', probed_at, time.time()))
+    if AUDIO_STORAGE == 'native':
+        remux_at = time.time()
+        remuxed = _remux_if_needed(filepath, info)
+        if remuxed != filepath:
+            filepath, size = remuxed, os.path.getsize(remuxed)
+        spans.append(('remux', remux_at, time.time()))
+
+    song = Track(
+        info.get('title', 'Unknown Track'),
+        os.path.abspath(filepath),
+        info.get('webpage_url', url),
+        info.get('duration', 0),
+        # Codec of the stored file, which differs from the source after the mp3 transcode
+        acodec='mp3' if filepath.endswith('.mp3') else (info.get('acodec') or '').split('.')[0] or None,
+        # Recorded here, in the worker, so playback needs no filesystem probes
+        size=size,
+    )
+    return _cache_key_for_info(info), song, spans
+
+
+@contextmanager
+def _download_lock(url: str):
+    """Serialize downloads of one track across shard processes sharing TRACK_CACHE_DIR.
+
+    Keyed on the track's cache key, so equivalent URLs (youtu.be links, extra
+    query parameters, playlist entries) share a lock; the raw URL is the
+    fallback when no key can be derived. The second process waits, then finds
+    the file already downloaded.
+    """
+    if fcntl is None:
+        yield
+        return
+    try:
+        key = _cache_key_for_url(url) or url
+    except Exception:
+        key = url
+    lock_dir = os.path.join(TRACK_CACHE_DIR, 'locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    path = os.path.join(lock_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lock')
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _remux_if_needed(filepath: str, info: Dict[str, Any]) -> str:
+    """Copy the audio stream into a playable audio-only container, without re-encoding.
+
+    Native downloads are normally webm/opus or m4a and are kept as is; this only
+    runs when yt-dlp had to fall back to a muxed or unusual container.
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+    has_video = info.get('vcodec') not in (None, 'none')
+    if ext in SUPPORTED_AUDIO_EXTENSIONS and not has_video:
+        return filepath
+
+    codec = (info.get('acodec') or '').split('.')[0]
+    target = os.path.splitext(filepath)[0] + REMUX_EXTENSIONS.get(codec, '.mka')
+    if target == filepath:
+        target = os.path.splitext(filepath)[0] + '.mka'
+    subprocess.run(
+        [FFMPEG_PATH, '-y', '-loglevel', 'error', '-i', filepath, '-vn', '-c:a', 'copy', target],
+        check=True, capture_output=True
+    )
+    os.remove(filepath)
+    return target
+
+
+def _ydl_process_info(info: Dict[str, Any], opts: Dict[str, Any]) -> None:
+    """Download an already resolved info dict (used for progressive downloads)."""
+    with youtube_dl.YoutubeDL(opts) as ydl:
+        ydl.process_info(info)
+
+# ==================== Process Pool Backend ====================
+class YdlProcessPool(Executor):
+    """Process-pool executor for yt-dlp jobs with crash isolation and timeouts.
+
+    Keeps extraction, JSON parsing and signature work out of the bot process so
+    it cannot hold the GIL against the voice threads. Workers are spawned and
+    warmed on start(). A job that outlives `timeout` fails with TimeoutError and
+    its pool is killed and replaced; jobs lost to a dead pool are retried once.
+    """
+
+    def __init__(self, workers: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # Spawned workers re-run this module from a copy of our environment; the flag
+                # keeps them from opening log files and caches they never use
+                os.environ['FOLDA_YDL_WORKER'] = '1'
+                try:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=_ydl_worker_init,
+                    )
+                    # Submitting one job per worker makes the pool spawn all of them now
+                    for _ in range(self.workers):
+                        self._pool.submit(_ydl_worker_init)
+                finally:
+                    os.environ.pop('FOLDA_YDL_WORKER', None)
+                bot_logger.info(f"Started {self.workers} download worker processes")
+            return self._pool
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        result: Future = Future()
+        self._run(result, fn, args, kwargs, retries=1)
+        return result
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def _run(self, result: Future, fn, args: tuple, kwargs: dict, retries: int) -> None:
+        pool = self.start()
+        try:
+            inner = pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool as e:
+            self._restart(pool)
+            if retries:
+                self._run(result, fn, args, kwargs, retries - 1)
+            else:
+                self._settle(result, exception=e)
+            return
+
+        timer = threading.Timer(self.timeout, self._expire, (pool, inner, result))
+        timer.daemon = True
+        timer.start()
+        result.add_done_callback(lambda r: inner.cancel() if r.cancelled() else None)
+
+        def _done(f: Future) -> None:
+            timer.cancel()
+            if f.cancelled():
+                self._settle(result, cancel=True)
+                return
+            error = f.exception()
+            if isinstance(error, BrokenProcessPool) and retries and not result.done():
+                bot_logger.warning(f"Download worker crashed, retrying {getattr(fn, '__name__', fn)}")
+                self._restart(pool)
+                self._run(result, fn, args, kwargs, retries - 1)
+            elif error is not None:
+                self._settle(result, exception=error)
+            else:
+                self._settle(result, value=f.result())
+
+        inner.add_done_callback(_done)
+
+    def _expire(self, pool: ProcessPoolExecutor, inner: Future, result: Future) -> None:
+        if inner.done():
+            return
+        bot_logger.error(f"Download job exceeded {self.timeout}s, restarting worker pool")
+        self._settle(result, exception=TimeoutError(f"download job exceeded {self.timeout}s"))
+        self._restart(pool, kill=True)
+
+    def _restart(self, pool: ProcessPoolExecutor, kill: bool = False) -> None:
+        with self._lock:
+            if self._pool is not pool:
+                return  # already replaced by another job
+            self._pool = None
+        if kill:
+            for process in list((pool._processes or {}).values()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.start()
+
+    def _settle(self, result: Future, value: Any = None, exception: Optional[BaseException] = None,
+                cancel: bool = False) -> None:
+        with self._lock:
+            if result.done():
+                return
+            if cancel:
+                result.cancel()
+            elif exception is not None:
+                result.set_exception(exception)
+            else:
+                result.set_result(value)
 
 # ==================== Downloader Module ====================
 class Downloader:
     """Handles all audio downloading with yt-dlp and parallel processing."""
 
     def __init__(self):
-        self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+        self.use_processes = DOWNLOAD_BACKEND == 'process'
+        if self.use_processes:
+            self.executor = YdlProcessPool(MAX_CONCURRENT_DOWNLOADS, DOWNLOAD_TIMEOUT)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+        self.scheduler = DownloadScheduler(self.executor, MAX_CONCURRENT_DOWNLOADS)
+        self.cache = TrackCache(TRACK_CACHE_DIR, TRACK_CACHE_MAX_MB * 1024 * 1024)
+        self.metadata = MetadataCache(os.path.join(CACHE_DIR, 'metadata.sqlite3'), METADATA_HOT_ENTRIES)
         self.ydl_opts_base = {
             'format': 'bestaudio/best',
-            'outtmpl': 'downloads/%(title)s.%(ext)s',
+            'outtmpl': os.path.join(TRACK_CACHE_DIR, '%(extractor_key)s', '%(id)s.%(ext)s'),
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': 'mp3',
@@ -347,73 +3170,214 @@ class Downloader:
             'no_warnings': True,
             'logger': yt_logger,
         }
+        if AUDIO_STORAGE == 'native':
+            # Store the best audio stream as delivered (usually webm/opus or m4a/aac);
+            # _remux_if_needed covers the rare muxed fallback without transcoding.
+            self.ydl_opts_base['format'] = 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio/best'
+            self.ydl_opts_base['postprocessors'] = []
+        # Progressive downloads keep the native stream (no mp3 post-processing) so
+        # ffmpeg can play the file while it is still being written.
+        self.ydl_opts_progressive = {
+            **self.ydl_opts_base,
+            'format': 'bestaudio[ext=webm]/bestaudio/best',
+            'postprocessors': [],
+            'nopart': True,
+        }
+        self.progressive: Dict[str, ProgressiveDownload] = {}
+
+    def warm_up(self) -> None:
+        """Spawn the download worker processes ahead of the first request."""
+        if self.use_processes:
+            self.executor.start()
+
+    @staticmethod
+    def _cancel_hook(cancelled: threading.Event):
+        """Progress hook that aborts a yt-dlp download once its job is cancelled."""
+        def hook(d):
+            if cancelled.is_set():
+                raise youtube_dl.utils.DownloadCancelled()
+        return hook
+
+    def _job_opts(self, opts: Dict[str, Any], *hooks) -> Dict[str, Any]:
+        """Options for a scheduled job; hooks are closures and cannot cross into worker processes."""
+        opts = dict(opts)
+        if not self.use_processes:
+            opts['progress_hooks'] = [*opts.get('progress_hooks', []), *hooks]
+        return opts
+
+    async def extract_info(self, url: str, download: bool = False, process: bool = True,
+                           opts: Optional[Dict[str, Any]] = None, guild_id: Optional[int] = None,
+                           interactive: bool = True) -> dict:
+        """Extract info from URL, optionally downloading.
+
+        Metadata-only lookups go through the metadata cache; everything else is
+        queued on the download scheduler for the requesting guild.
+        """
+        opts = dict(opts or self.ydl_opts_base)
+        loop = asyncio.get_event_loop()
+        if download:
+            cancelled = threading.Event()
+            return await self.scheduler.submit(
+                _ydl_extract, url, self._job_opts(opts, self._cancel_hook(cancelled)), True, process,
+                guild_id=guild_id, interactive=interactive, cancelled=cancelled
+            )
 
-    async def extract_info(self, url: str, download: bool = False, process: bool = True) -> dict:
-        """Extract info from URL, optionally downloading."""
-        opts = self.ydl_opts_base.copy()
-        if not download:
-            opts['extract_flat'] = 'in_playlist'
-
-        def _extract():
-            with youtube_dl.YoutubeDL(opts) as ydl:
-                return ydl.extract_info(url, download=download, process=process)
+        opts['extract_flat'] = 'in_playlist'
+        cache_key = f"{opts['format']}|{int(process)}|{url}"
+        with trace_span('extract_info', cached=True) as span:
+            info = self.metadata.get_hot(cache_key)
+            if info is None:
+                info = await loop.run_in_executor(None, self.metadata.get, cache_key)
+            metrics.cache_lookups.add(('metadata', 'miss' if info is None else 'hit'))
+            if info is not None:
+                return info
+
+            span['cached'] = False
+            info = await self.scheduler.submit(
+                _ydl_extract, url, opts, False, process, guild_id=guild_id, interactive=interactive
+            )
+        if info:
+            await loop.run_in_executor(None, self.metadata.put, cache_key, MetadataCache.kind_of(url, info), info)
+        return info
 
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _extract)
+    async def download_progressive(self, url: str, guild_id: Optional[int] = None) -> Optional[Track]:
+        """Start downloading a track and return its song dict once enough is on disk to play.
 
-    async def download_single(self, url: str) -> Optional[Dict[str, Any]]:
-        """Download a single track and return song dict."""
+        The download continues in the background; playback follows the growing
+        file through ProgressiveDownload until the complete file is in place.
+        """
         try:
-            info = await self.extract_info(url, download=True)
+            cached = await self._cache_lookup(url)
+            if cached:
+                return cached
+
+            info = await self.extract_info(url, download=False, opts=self.ydl_opts_progressive,
+                                           guild_id=guild_id)
             if not info:
                 return None
 
-            # Determine actual file path
-            filepath = youtube_dl.YoutubeDL(self.ydl_opts_base).prepare_filename(info)
-            base = os.path.splitext(filepath)[0]
-            for ext in SUPPORTED_AUDIO_EXTENSIONS:
-                test_path = base + ext
-                if os.path.exists(test_path):
-                    filepath = test_path
-                    break
+            filepath = os.path.abspath(youtube_dl.YoutubeDL(self.ydl_opts_progressive).prepare_filename(info))
+            song = Track(
+                info.get('title', 'Unknown Track'),
+                filepath,
+                info.get('webpage_url', url),
+                info.get('duration', 0),
+                acodec=(info.get('acodec') or '').split('.')[0] or None,
+            )
 
-            return {
-                'title': info.get('title', 'Unknown Track'),
-                'url': os.path.abspath(filepath),
-                'webpage_url': info.get('webpage_url', url),
-                'duration': info.get('duration', 0),
-            }
+            key = _cache_key_for_info(info)
+            loop = asyncio.get_running_loop()
+            exists = filepath not in self.progressive and await loop.run_in_executor(None, os.path.exists, filepath)
+            # Checked again after the await: another request may have started this download meanwhile
+            download = self.progressive.get(filepath)
+            if download is None:
+                if exists:
+                    if key:
+                        await loop.run_in_executor(None, self.cache.put, key, song)
+                    return song
+
+                download = ProgressiveDownload(filepath, asyncio.get_running_loop())
+                self.progressive[filepath] = download
+                cancelled = threading.Event()
+                opts = self._job_opts(self.ydl_opts_progressive, download.progress_hook, self._cancel_hook(cancelled))
+                # The background download holds its scheduler slot until the file is complete
+                future = self.scheduler.submit(_ydl_process_info, info, opts, guild_id=guild_id, cancelled=cancelled)
+                future.add_done_callback(lambda f: self._progressive_done(url, key, song, download, f))
+                if self.use_processes:
+                    asyncio.create_task(download.watch_file())
+
+            with trace_span('progressive_ready'):
+                ready = await asyncio.wait_for(asyncio.shield(download.ready), DOWNLOAD_TIMEOUT)
+            return song if ready else None
         except Exception as e:
             bot_logger.error(f"Download failed for {url}: {str(e)}")
             return None
 
-    async def download_playlist_batch(self, entries: List[Dict], requester: str,
-                                     progress_callback=None) -> List[Dict]:
-        """Download multiple playlist entries concurrently with semaphore control."""
-        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    def _progressive_done(self, url: str, key: Optional[str], song: Track,
+                          download: ProgressiveDownload, future: asyncio.Future) -> None:
+        self.progressive.pop(download.path, None)
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        download.finish(error)
+        if error is not None:
+            bot_logger.error(f"Progressive download failed for {url}: {error!r}")
+        elif key:
+            asyncio.get_event_loop().run_in_executor(None, self.cache.put, key, song)
+
+    async def download_single(self, url: str, progressive: bool = False, guild_id: Optional[int] = None,
+                              interactive: bool = True) -> Optional[Track]:
+        """Download a single track and return it.
+
+        Interactive requests jump ahead of bulk (prefetch) downloads on the scheduler.
+        """
+        if progressive:
+            return await self.download_progressive(url, guild_id=guild_id)
+        try:
+            cached = await self._cache_lookup(url)
+            if cached:
+                return cached
+
+            cancelled = threading.Event()
+            submitted = time.time()
+            result = await self.scheduler.submit(
+                _ydl_download, url, self._job_opts(self.ydl_opts_base, self._cancel_hook(cancelled)),
+                guild_id=guild_id, interactive=interactive, cancelled=cancelled
+            )
+            if not result:
+                return None
 
-        async def download_one(entry):
-            async with semaphore:
-                video_url = entry.get('webpage_url') or f"https://youtu.be/{entry['id']}"
-                song = await self.download_single(video_url)
-                if song:
-                    song['requester'] = requester
-                    if progress_callback:
-                        await progress_callback(song)
-                return song
+            key, song, spans = result
+            metrics.download_seconds.observe(time.time() - submitted)
+            # Time between submitting the job and the worker picking it up
+            trace_spans([('download_queue_wait', submitted, spans[0][1]), *spans])
+            if key:
+                await asyncio.get_event_loop().run_in_executor(None, self.cache.put, key, song)
+            return song
+        except Exception as e:
+            bot_logger.error(f"Download failed for {url}: {str(e)}")
+            return None
 
-        tasks = [download_one(e) for e in entries if e]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        return [r for r in results if isinstance(r, dict)]
+    async def _cache_lookup(self, url: str) -> Optional[Track]:
+        """Return the cached song for a URL, if any, without touching the network."""
+        with trace_span('cache_lookup', hit=False) as span:
+            # Extractor matching, SQLite and a stat of the cached file: all off the event loop
+            key, song = await asyncio.get_running_loop().run_in_executor(None, self._cached_track, url)
+            metrics.cache_lookups.add(('track', 'hit' if song else 'miss'))
+            if song:
+                span['hit'] = True
+                bot_logger.info(f"Track cache hit for {key}")
+            return song
+
+    def _cached_track(self, url: str) -> Tuple[Optional[str], Optional[Track]]:
+        """Cache key and cached song for a URL; blocking."""
+        try:
+            key = _cache_key_for_url(url)
+        except Exception as e:
+            bot_logger.warning(f"Could not derive cache key for {url}: {str(e)}")
+            return None, None
+        return key, self.cache.get(key) if key else None
 
-downloader = Downloader()
+# Download workers only need the yt-dlp job functions, not the track and metadata caches
+downloader = None if YDL_WORKER else Downloader()
+frame_cache = FrameCache(os.path.join(CACHE_DIR, 'frames'), FRAME_CACHE_MAX_MB * 1024 * 1024)
+startup.mark('caches + downloader')
 
 # ==================== Music Cog ====================
 class Music(commands.Cog):
     """Music playback commands."""
+    PLAYLIST_CHUNK = 250  # playlist entries parsed, checked and queued at a time
+    PLAYLIST_FIRST_CHUNK = 25  # smaller, so playback starts sooner
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+    async def cog_before_invoke(self, ctx: commands.Context) -> None:
+        # Any command counts as activity for the idle reaper
+        if ctx.guild:
+            state = get_guild_state(ctx.guild.id)
+            state.last_activity = time.time()
+            # The saved queue is restored in the background; commands act on it, not on an empty one
+            await state.loaded.wait()
+
     async def ensure_voice(self, ctx: commands.Context) -> bool:
         """Ensure bot is connected to a voice channel."""
         if ctx.voice_client and ctx.voice_client.is_connected():
@@ -425,7 +3389,8 @@ class Music(commands.Cog):
 
         channel = ctx.author.voice.channel
         try:
-            await channel.connect(timeout=VOICE_TIMEOUT, reconnect=True)
+            with trace_span('voice_connect'):
+                await channel.connect(timeout=VOICE_TIMEOUT, reconnect=True)
             last_join_channels[ctx.guild.id] = channel
             return True
         except Exception as e:
@@ -440,7 +3405,10 @@ class Music(commands.Cog):
           !playnext <queue_number>   - move that song to next
           !playnext <youtube link>   - download and add as next
           !playnext <local_file>     - add local file as next
+          !playnext <search>         - add the best local library match as next
         """
+        if args.strip().startswith(('http://', 'https://')):
+            tracer.start('playnext', ctx.guild.id, ctx.author.display_name, query=args.strip())
         if not await self.ensure_voice(ctx):
             return
 
@@ -456,55 +3424,51 @@ class Music(commands.Cog):
                 return
 
             async with state.lock:
-                if index < 1 or index > len(state.queue_list):
-                    await ctx.send(f"ERROR Queue only has {len(state.queue_list)} songs.")
+                if index < 1 or index > len(state.queue):
+                    await ctx.send(f"ERROR Queue only has {len(state.queue)} songs.")
                     return
 
-                song = state.queue_list.pop(index - 1)
-                state.queue_list.insert(0, song)
-
-                # Rebuild the internal asyncio.Queue to match the new order
-                state.queue._queue.clear()
-                for item in state.queue_list:
-                    state.queue._queue.append(item)
+                song = state.queue.move_to_front(index - 1)
+                state.schedule_prefetch()
 
-            await ctx.send(f"Moved **{song['title']}** to next in queue.")
+            await ctx.send(f"Moved **{song.title}** to next in queue.")
 
         # --- Download a YouTube / direct URL and add to front ---
         elif args.startswith(('http://', 'https://')):
             msg = await ctx.send("Downloading...")
-            song = await downloader.download_single(args)
+            song = await downloader.download_single(args, progressive=PROGRESSIVE_PLAYBACK,
+                                                    guild_id=ctx.guild.id)
             if not song:
-                await msg.edit(content="ERROR Failed to download track")
+                notifier.edit(msg, "ERROR Failed to download track")
+                tracer.finish(current_trace.get(), error="download failed")
                 return
 
-            song['requester'] = ctx.author.display_name
+            song.requester = ctx.author.display_name
+            tracer.attach(song)
 
             async with state.lock:
-                state.queue_list.insert(0, song)
-                state.queue._queue.appendleft(song)
+                state.queue.appendleft(song)
 
-            await msg.edit(content=f"OK Added next: **{song['title']}**")
+            notifier.edit(msg, f"OK Added next: **{song.title}**")
 
-        # --- Local file ---
+        # --- Local file: a path, or a search of the local library ---
         else:
             filepath = args
-            if not os.path.exists(filepath):
-                await ctx.send(f"ERROR File not found: {filepath}")
-                return
-
-            song = {
-                'title': os.path.basename(filepath),
-                'url': filepath,
-                'requester': ctx.author.display_name,
-                'duration': 0,
-            }
+            if library.entry_for(filepath):
+                song = library.track_for(filepath, ctx.author.display_name)
+            elif await asyncio.get_running_loop().run_in_executor(None, os.path.isfile, filepath):
+                song = library.track_for(filepath, ctx.author.display_name)
+            else:
+                matches = library.search(args, limit=1)
+                if not matches:
+                    await ctx.send(f"ERROR File not found: {filepath}")
+                    return
+                song = matches[0].track(ctx.author.display_name)
 
             async with state.lock:
-                state.queue_list.insert(0, song)
-                state.queue._queue.appendleft(song)
+                state.queue.appendleft(song)
 
-            await ctx.send(f"OK Added next: **{song['title']}**")
+            await ctx.send(f"OK Added next: **{song.title}**")
 
         # If the bot wasn't already playing, start the playback loop
         if not state.is_playing:
@@ -517,6 +3481,10 @@ class Music(commands.Cog):
         if not await self.ensure_voice(ctx):
             return
         await ctx.send(f"OK Joined {ctx.author.voice.channel.name}")
+        # Pick up a queue restored after a restart
+        state = get_guild_state(ctx.guild.id)
+        if state.queue and not state.is_playing:
+            await state.start_playback_loop(ctx)
 
     @commands.command(name='leave')
     async def leave(self, ctx: commands.Context):
@@ -528,19 +3496,22 @@ class Music(commands.Cog):
             await ctx.voice_client.disconnect()
 
         async with state.lock:
-            state.queue = asyncio.Queue()
-            state.queue_list.clear()
+            state.queue.clear()
             state.current_song = None
-            state.loop_type = None
             state.history.clear()
+            state.set_loop(None)
+            state.cancel_prefetch()
             state.is_playing = False
             state.playback_active = False
+            queue_store.record(state, 'reset')
+        downloader.scheduler.cancel_guild(ctx.guild.id)
 
         await ctx.send("OK Left voice channel and cleared queue")
 
     @commands.command(name='stream')
     async def stream(self, ctx: commands.Context, *, query: str):
         """Stream audio from URL or search YouTube."""
+        tracer.start('stream', ctx.guild.id, ctx.author.display_name, query=query)
         if not await self.ensure_voice(ctx):
             return
 
@@ -554,54 +3525,85 @@ class Music(commands.Cog):
                 await self._handle_single_url(ctx, query)
             return
 
+        # Local library first; matches there never touch YouTube. "yt:" skips the library.
+        if query.lower().startswith('yt:'):
+            query = query[3:].strip()
+        else:
+            local = library.search(query, limit=5)
+            if local:
+                await self._handle_local_search(ctx, query, local)
+                return
+
         # Search YouTube
         try:
-            info = await downloader.extract_info(f"ytsearch5:{query}", download=False)
+            info = await downloader.extract_info(f"ytsearch5:{query}", download=False, guild_id=ctx.guild.id)
             entries = info.get('entries', [])[:5]
             if not entries:
                 await ctx.send("ERROR No results found.")
                 return
 
-            # Create selection view
-            view = SearchView(entries, ctx)
-            lines = [f"**Search Results for '{query}':**"]
-            for idx, entry in enumerate(entries, 1):
-                title = entry.get('title', 'Unknown')[:45]
-                duration = entry.get('duration', 0) or 0
-                mins, secs = divmod(int(duration), 60)
-                lines.append(f"{idx}. {title} ({mins}:{secs:02d})")
-
-            msg = await ctx.send("\n".join(lines), view=view)
-            view.message = msg
-
-            await view.wait()
-            if view.selected_entry is None:
-                await msg.edit(content="Selection timed out.", view=None)
+            selected = await self._select(ctx, f"**Search Results for '{query}':**", entries,
+                                          [(entry.get('title', 'Unknown'), entry.get('duration')) for entry in entries])
+            if selected is None:
                 return
-
-            selected_url = view.selected_entry.get('webpage_url') or f"https://youtu.be/{view.selected_entry['id']}"
+            selected_url = selected.get('webpage_url') or f"https://youtu.be/{selected['id']}"
             await self._handle_single_url(ctx, selected_url)
         except Exception as e:
             bot_logger.error(f"Search error: {traceback.format_exc()}")
             await ctx.send("ERROR Search failed")
 
+    async def _select(self, ctx: commands.Context, heading: str, entries: List[Any],
+                      rows: List[Tuple[str, Optional[int]]]) -> Optional[Any]:
+        """Show numbered choices with buttons and wait for the requester's pick."""
+        view = SearchView(entries, ctx)
+        lines = [heading]
+        for idx, (title, duration) in enumerate(rows, 1):
+            mins, secs = divmod(int(duration or 0), 60)
+            lines.append(f"{idx}. {title[:45]} ({mins}:{secs:02d})")
+
+        msg = await ctx.send("\n".join(lines), view=view)
+        view.message = msg
+
+        with trace_span('user_select'):
+            await view.wait()
+        if view.selected_entry is None:
+            await msg.edit(content="Selection timed out.", view=None)
+        return view.selected_entry
+
+    async def _handle_local_search(self, ctx: commands.Context, query: str, entries: List[LibraryEntry]):
+        """Offer local library matches for a search and queue the chosen file."""
+        selected = await self._select(
+            ctx, f"**Local library results for '{query}':** (`{BOT_PREFIX}stream yt:{query}` searches YouTube)",
+            entries, [(entry.display_title, entry.duration) for entry in entries])
+        if selected is None:
+            return
+        state = get_guild_state(ctx.guild.id)
+        song = selected.track(ctx.author.display_name)
+        tracer.attach(song)
+        async with state.lock:
+            state.queue.append(song)
+        notifier.send(ctx, f"OK Added: **{song.title}**")
+        if not state.is_playing:
+            await state.start_playback_loop(ctx)
+
     async def _handle_single_url(self, ctx: commands.Context, url: str):
         """Process a single URL."""
         state = get_guild_state(ctx.guild.id)
         msg = await ctx.send("Downloading...")
 
-        song = await downloader.download_single(url)
+        song = await downloader.download_single(url, progressive=PROGRESSIVE_PLAYBACK, guild_id=ctx.guild.id)
         if not song:
-            await msg.edit(content="ERROR Failed to download track")
+            notifier.edit(msg, "ERROR Failed to download track")
+            tracer.finish(current_trace.get(), error="download failed")
             return
 
-        song['requester'] = ctx.author.display_name
+        song.requester = ctx.author.display_name
+        tracer.attach(song)
 
         async with state.lock:
-            await state.queue.put(song)
-            state.queue_list.append(song)
+            state.queue.append(song)
 
-        await msg.edit(content=f"OK Added: **{song['title']}**")
+        notifier.edit(msg, f"OK Added: **{song.title}**")
 
         if not state.is_playing:
             await state.start_playback_loop(ctx)
@@ -612,57 +3614,32 @@ class Music(commands.Cog):
         status_msg = await ctx.send("Analyzing playlist...")
 
         try:
-            info = await downloader.extract_info(url, download=False, process=False)
+            info = await downloader.extract_info(url, download=False, process=False, guild_id=ctx.guild.id)
             entries = [e for e in info.get('entries', []) if e]
             total = len(entries)
             if total == 0:
-                await status_msg.edit(content="ERROR No valid tracks in playlist")
+                notifier.edit(status_msg, "ERROR No valid tracks in playlist")
                 return
+            entries = entries[:MAX_PLAYLIST_ITEMS]
 
+            # Queue lazy tracks right away; the prefetcher downloads them as they near the front
             playlist_title = info.get('title', 'Playlist')
-            await status_msg.edit(content=f"Adding **{total}** tracks from: {playlist_title}")
-
-            # Add placeholder entries to queue_list only (display purposes)
+            requester = ctx.author.display_name
+            songs = []
+            for entry in entries:
+                webpage_url = entry.get('webpage_url') or f"https://youtu.be/{entry['id']}"
+                songs.append(Track(entry.get('title', 'Unknown'), webpage_url, webpage_url, entry.get('duration'),
+                                   requester, status='pending'))
+            # The request is traced through to the first track of the playlist
+            tracer.attach(songs[0])
             async with state.lock:
-                for entry in entries:
-                    placeholder = {
-                        'title': entry.get('title', 'Unknown'),
-                        'url': entry.get('webpage_url') or f"https://youtu.be/{entry['id']}",
-                        'requester': ctx.author.display_name,
-                        'duration': entry.get('duration', 0),
-                        'status': 'pending'
-                    }
-                    state.queue_list.append(placeholder)
-
-            # Download concurrently with progress
-            completed = 0
-            progress_msg = await ctx.send(f"Downloading 0/{total}...")
-
-            async def progress_callback(song):
-                nonlocal completed
-                completed += 1
-                await progress_msg.edit(content=f"Downloading {completed}/{total}...")
-
-            downloaded = await downloader.download_playlist_batch(
-                entries,
-                ctx.author.display_name,
-                progress_callback=progress_callback
-            )
+                state.queue.extend(songs)
+                state.schedule_prefetch()
 
-            # Replace placeholders with actual downloaded songs
-            async with state.lock:
-                # Remove all placeholders
-                state.queue_list = [s for s in state.queue_list if s.get('status') != 'pending']
-                for song in downloaded:
-                    await state.queue.put(song)
-                    state.queue_list.append(song)
-
-            if downloaded:
-                await progress_msg.edit(content=f"OK Added **{len(downloaded)}** tracks from playlist **{playlist_title}**")
-            else:
-                await progress_msg.edit(content=f"ERROR Failed to download any tracks from the playlist")
+            skipped = f" (limited to the first {MAX_PLAYLIST_ITEMS} of {total})" if total > len(entries) else ""
+            notifier.edit(status_msg, f"OK Added **{len(entries)}** tracks from playlist **{playlist_title}**{skipped}")
 
-            if not state.is_playing and downloaded:
+            if not state.is_playing:
                 await state.start_playback_loop(ctx)
 
         except Exception as e:
@@ -673,45 +3650,12 @@ class Music(commands.Cog):
     async def queue(self, ctx: commands.Context):
         """Show current queue."""
         state = get_guild_state(ctx.guild.id)
-        if not state.current_song and not state.queue_list:
+        if not state.current_song and not state.queue:
             await ctx.send("Queue is empty")
             return
 
-        messages = []
-        current_message = []
-
-        # Now playing
-        if state.current_song:
-            elapsed = int(time.time() - state.start_time)
-            elapsed_str = f"{elapsed//60}:{elapsed%60:02d}"
-            dur = int(state.current_song.get('duration', 0))
-            dur_str = f"{dur//60}:{dur%60:02d}" if dur else "??:??"
-            current_message.append(f"**Now Playing:** {state.current_song['title']}")
-            current_message.append(f"`{elapsed_str}/{dur_str}` | Requested by {state.current_song['requester']}")
-
-        # Upcoming queue
-        if state.queue_list:
-            if current_message:
-                current_message.append("\n**Upcoming:**")
-            else:
-                current_message.append("**Upcoming:**")
-
-            for idx, song in enumerate(state.queue_list, 1):
-                dur = int(song.get('duration', 0))
-                dur_str = f"{dur//60}:{dur%60:02d}" if dur else "??:??"
-                line = f"{idx}. {song['title']} ({dur_str}) | {song['requester']}"
-
-                if len('\n'.join(current_message + [line])) > 1900:
-                    messages.append('\n'.join(current_message))
-                    current_message = ["**Upcoming (cont'd):**", line]
-                else:
-                    current_message.append(line)
-
-        if current_message:
-            messages.append('\n'.join(current_message))
-
-        for msg in messages:
-            await ctx.send(msg)
+        view = QueueView(state, ctx)
+        view.message = await ctx.send(view.render(), view=view if view.pages > 1 else None)
 
     @commands.command(name='remove')
     async def remove(self, ctx: commands.Context, index: int):
@@ -719,28 +3663,23 @@ class Music(commands.Cog):
         state = get_guild_state(ctx.guild.id)
 
         async with state.lock:
-            if index < 1 or index > len(state.queue_list):
-                await ctx.send(f"ERROR Invalid index. Queue has {len(state.queue_list)} songs.")
+            if index < 1 or index > len(state.queue):
+                await ctx.send(f"ERROR Invalid index. Queue has {len(state.queue)} songs.")
                 return
 
-            removed = state.queue_list.pop(index - 1)
-            # Mark as removed so the playback loop can skip it when it reaches the front
-            removed['removed'] = True
+            removed = state.queue.pop(index - 1)
+            state.schedule_prefetch()
 
-        await ctx.send(f"OK Removed: **{removed['title']}**")
+        await ctx.send(f"OK Removed: **{removed.title}**")
 
     @commands.command(name='clear')
     async def clear(self, ctx: commands.Context):
         """Clear the queue."""
         state = get_guild_state(ctx.guild.id)
-        size = state.queue.qsize()
-        while not state.queue.empty():
-            try:
-                await state.queue.get()
-            except:
-                pass
         async with state.lock:
-            state.queue_list.clear()
+            size = len(state.queue)
+            state.queue.clear()
+            state.cancel_prefetch()
         await ctx.send(f"OK Cleared {size} songs from queue")
 
     @commands.command(name='skip')
@@ -777,13 +3716,14 @@ class Music(commands.Cog):
         if ctx.voice_client:
             ctx.voice_client.stop()
         async with state.lock:
-            state.queue = asyncio.Queue()
-            state.queue_list.clear()
+            state.queue.clear()
             state.current_song = None
-            state.loop_type = None
             state.history.clear()
+            state.set_loop(None)
+            state.cancel_prefetch()
             state.is_playing = False
             state.playback_active = False
+            queue_store.record(state, 'reset')
         await ctx.send("Stopped")
 
     @commands.command(name='shuffle')
@@ -791,18 +3731,12 @@ class Music(commands.Cog):
         """Shuffle the queue."""
         state = get_guild_state(ctx.guild.id)
         async with state.lock:
-            if state.queue.qsize() < 2:
+            if len(state.queue) < 2:
                 await ctx.send("Need at least 2 songs to shuffle")
                 return
 
-            items = []
-            while not state.queue.empty():
-                items.append(await state.queue.get())
-
-            random.shuffle(items)
-            state.queue_list = items.copy()
-            for item in items:
-                await state.queue.put(item)
+            state.queue.shuffle()
+            state.schedule_prefetch()
 
         await ctx.send("Queue shuffled")
 
@@ -811,57 +3745,87 @@ class Music(commands.Cog):
         """Toggle loop mode."""
         state = get_guild_state(ctx.guild.id)
         if state.loop_type is None:
-            state.loop_type = 'queue'
+            state.set_loop('queue')
             await ctx.send("Looping queue")
         elif state.loop_type == 'queue':
-            state.loop_type = 'song'
+            state.set_loop('song')
             await ctx.send("Looping current song")
         else:
-            state.loop_type = None
+            state.set_loop(None)
             await ctx.send("Looping disabled")
+        queue_store.record(state, 'loop', mode=state.loop_type)
 
     @commands.command(name='playlist_local')
     async def playlist_local(self, ctx: commands.Context, filename: str):
-        """Load local playlist file."""
+        """Load a local M3U/M3U8/PLS playlist (or a plain list of paths).
+
+        The file is parsed and its paths checked in the executor, a chunk at a
+        time; each chunk is queued as soon as it is checked, so playback starts
+        with the first valid tracks while the rest are still loading.
+        """
         state = get_guild_state(ctx.guild.id)
         filepath = os.path.join(os.getcwd(), filename)
-
-        if not os.path.exists(filepath):
-            await ctx.send(f"File not found: {filename}")
-            return
+        requester = ctx.author.display_name
+        loop = asyncio.get_running_loop()
+        entries = iter_playlist(filepath)
+        added = missing = skipped = 0
+        msg = None
 
         try:
-            with open(filepath, 'r') as f:
-                lines = [line.strip() for line in f if line.strip()]
-
-            added = 0
-            async with state.lock:
-                for line in lines:
-                    if os.path.exists(line):
-                        song = {
-                            'title': os.path.basename(line),
-                            'url': line,
-                            'requester': ctx.author.display_name,
-                            'duration': 0
-                        }
-                        await state.queue.put(song)
-                        state.queue_list.append(song)
-                        added += 1
+            while True:
+                count = self.PLAYLIST_CHUNK if added else self.PLAYLIST_FIRST_CHUNK
+                chunk = await loop.run_in_executor(None, list, itertools.islice(entries, count))
+                if not chunk:
+                    break
+                if msg is None:
+                    msg = await ctx.send("Loading playlist...")
+                sizes = await asyncio.gather(*(loop.run_in_executor(None, _local_file_size, path)
+                                               for path, _, _ in chunk))
+                songs = []
+                for (path, title, duration), size in zip(chunk, sizes):
+                    if path.startswith(('http://', 'https://')):
+                        skipped += 1
+                    elif not size:
+                        missing += 1
+                        if missing <= MessageCoalescer.MAX_WARNING_LINES:
+                            notifier.warn(ctx, f"File not found: {path}")
                     else:
-                        await ctx.send(f"Warning: File not found: {line}")
-
-            await ctx.send(f"OK Added {added} local files to queue")
-            if not state.is_playing and added > 0:
-                await state.start_playback_loop(ctx)
+                        song = library.track_for(path, requester)
+                        song.title = title or song.title
+                        song.duration = duration or song.duration
+                        song.size = size
+                        songs.append(song)
+
+                if songs:
+                    # Only the bulk insert runs under the lock
+                    async with state.lock:
+                        state.queue.extend(songs)
+                    added += len(songs)
+                    if not state.is_playing:
+                        await state.start_playback_loop(ctx)
+                notifier.edit(msg, f"Loading playlist... {added} tracks queued")
+        except FileNotFoundError:
+            await ctx.send(f"File not found: {filename}")
+            return
         except Exception as e:
             await ctx.send(f"ERROR: {str(e)}")
+            return
+        finally:
+            entries.close()
+
+        notes = [f"{count} {label}" for count, label in ((missing, "missing"), (skipped, "URLs skipped")) if count]
+        result = f"OK Added {added} local files to queue" + (f" ({', '.join(notes)})" if notes else "")
+        if msg is None:
+            await ctx.send(result)
+        else:
+            notifier.edit(msg, result)
 
     @commands.command(name='usage')
     async def usage(self, ctx: commands.Context):
         """Show data usage."""
-        data = DATA_USAGE[ctx.guild.id]
-        mb = data['total_bytes'] / 1024 / 1024
-        uptime = time.time() - data['start_time']
+        state = get_guild_state(ctx.guild.id)
+        mb = metrics.stream_bytes.values().get(ctx.guild.id, 0) / 1024 / 1024
+        uptime = time.time() - state.created_at
         hours, rem = divmod(uptime, 3600)
         minutes, _ = divmod(rem, 60)
         await ctx.send(f"**Data Usage:** {mb:.2f} MB\n**Uptime:** {int(hours)}h {int(minutes)}m")
@@ -873,11 +3837,11 @@ class Music(commands.Cog):
             "**Folda Tunez Commands**\n"
             f"`{BOT_PREFIX}join` - Join voice channel\n"
             f"`{BOT_PREFIX}leave` - Leave and clear queue\n"
-            f"`{BOT_PREFIX}stream <url/search>` - Play from YouTube or search\n"
+            f"`{BOT_PREFIX}stream <url/search>` - Play a URL, or search the local library then YouTube (`yt:` skips the library)\n"
             f"`{BOT_PREFIX}queue` - Show queue\n"
             f"`{BOT_PREFIX}remove <number>` - Remove song from queue by number\n"
             f"`{BOT_PREFIX}clear` - Clear queue\n"
-            f"`{BOT_PREFIX}playnext <number|url|file>` - Add a song to the front of the queue\n"
+            f"`{BOT_PREFIX}playnext <number|url|file|search>` - Add a song to the front of the queue\n"
             f"`{BOT_PREFIX}skip` - Skip current track\n"
             f"`{BOT_PREFIX}pause` / `resume` - Pause/Resume\n"
             f"`{BOT_PREFIX}stop` - Stop and clear\n"
@@ -919,17 +3883,100 @@ class SearchView(View):
         if self.message:
             await self.message.edit(view=self)
 
+# ==================== Queue View ====================
+def format_duration(seconds: int) -> str:
+    seconds = int(seconds or 0)
+    if not seconds:
+        return "??:??"
+    hours, rest = divmod(seconds, 3600)
+    if hours:
+        return f"{hours}:{rest//60:02d}:{rest%60:02d}"
+    return f"{rest//60}:{rest%60:02d}"
+
+def _queue_line(song: Track) -> str:
+    return f"{song.title} ({format_duration(song.duration)}) | {song.requester or 'Unknown'}"
+
+class QueueView(View):
+    """Paged !queue listing; only the visible page is ever rendered."""
+    PAGE_SIZE = 15
+
+    def __init__(self, state: GuildState, ctx):
+        super().__init__(timeout=120)
+        self.state = state
+        self.ctx = ctx
+        self.page = 0
+        self.message = None
+
+        self.prev_button = Button(style=discord.ButtonStyle.secondary, label="Prev")
+        self.prev_button.callback = self.make_callback(-1)
+        self.add_item(self.prev_button)
+        self.next_button = Button(style=discord.ButtonStyle.secondary, label="Next")
+        self.next_button.callback = self.make_callback(1)
+        self.add_item(self.next_button)
+        self._sync_buttons()
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-len(self.state.queue) // self.PAGE_SIZE))
+
+    def _sync_buttons(self):
+        self.page = min(self.page, self.pages - 1)
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= self.pages - 1
+
+    def render(self) -> str:
+        state = self.state
+        lines = []
+
+        if state.current_song:
+            elapsed = int(time.time() - state.start_time)
+            lines.append(f"**Now Playing:** {state.current_song.title}")
+            lines.append(f"`{format_duration(elapsed) if elapsed else '0:00'}/{format_duration(state.current_song.duration)}`"
+                         f" | Requested by {state.current_song.requester or 'Unknown'}")
+
+        if state.queue:
+            start = self.page * self.PAGE_SIZE
+            if lines:
+                lines.append("")
+            lines.append("**Upcoming:**")
+            page_lines = state.queue.lines(start, start + self.PAGE_SIZE, _queue_line)
+            lines.extend(f"{start + idx}. {line}" for idx, line in enumerate(page_lines, 1))
+            lines.append(f"\nPage {self.page + 1}/{self.pages} | {len(state.queue)} tracks"
+                         f" | {format_duration(state.queue.total_duration)} total")
+
+        return '\n'.join(lines)[:1990] or "Queue is empty"
+
+    def make_callback(self, step: int):
+        async def callback(interaction: discord.Interaction):
+            self.page = max(0, self.page + step)
+            self._sync_buttons()
+            await interaction.response.edit_message(content=self.render(), view=self)
+        return callback
+
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
 # ==================== Admin CLI (with robust input) ====================
 class AdminCLI:
     """CLI for remote administration."""
 
-    def __init__(self, bot: commands.Bot):
+    # Each shard process numbers its guilds and channels from its own block,
+    # so BOT IDs stay unique and the supervisor can route by them
+    ID_BLOCK = 100000
+
+    def __init__(self, bot: Optional[commands.Bot], id_offset: int = 0):
         self.bot = bot
         self.running = True
         self.guild_ids = {}
         self.channel_ids = {}
-        self.next_guild_id = 1
-        self.next_channel_id = 1
+        self.next_guild_id = id_offset + 1
+        self.next_channel_id = id_offset + 1
 
     def safe_input(self, prompt: str) -> str:
         """Read input with encoding error handling."""
@@ -958,7 +4005,40 @@ class AdminCLI:
                 break
             except Exception as e:
                 cli_logger.error(f"CLI error: {traceback.format_exc()}")
-                print(f"Error: {str(e)}")
+                _print(f"Error: {str(e)}")
+
+    def serve(self, conn) -> None:
+        """Run commands sent by the shard supervisor and reply with their output."""
+        loop = asyncio.get_running_loop()
+
+        def read_commands():
+            # A daemon thread rather than the executor, so a pending recv never holds up exit
+            while True:
+                try:
+                    request_id, cmd_line = conn.recv()
+                except (EOFError, OSError):
+                    bot_logger.warning("Lost the shard supervisor; shutting down")
+                    asyncio.run_coroutine_threadsafe(self.bot.close(), loop)
+                    return
+                asyncio.run_coroutine_threadsafe(self._answer(conn, request_id, cmd_line), loop)
+
+        threading.Thread(target=read_commands, name='supervisor-commands', daemon=True).start()
+
+    async def _answer(self, conn, request_id: int, cmd_line: str) -> None:
+        # Each request is its own task, so concurrent requests never share a reply
+        reply = _CliReply()
+        cli_reply.set(reply)
+        try:
+            await self.process_command(cmd_line)
+        except Exception as e:
+            cli_logger.error(f"CLI error: {traceback.format_exc()}")
+            _print(f"Error: {str(e)}")
+        finally:
+            reply.open = False
+        try:
+            conn.send((request_id, reply.buffer.getvalue()))
+        except (EOFError, OSError):
+            pass
 
     async def process_command(self, cmd_line: str):
         parts = cmd_line.split(maxsplit=1)
@@ -980,6 +4060,11 @@ class AdminCLI:
             'loop': self.cmd_loop,
             'playlist_local': self.cmd_playlist_local,
             'usage': self.cmd_usage,
+            'cache': self.cmd_cache,
+            'traces': self.cmd_traces,
+            'memory': self.cmd_memory,
+            'library': self.cmd_library,
+            'startup': self.cmd_startup,
             'kill': self.cmd_kill,
             'exit': self.cmd_exit,
         }
@@ -987,7 +4072,7 @@ class AdminCLI:
         if cmd in handlers:
             await handlers[cmd](args)
         else:
-            print(f"Unknown command: {cmd}")
+            _print(f"Unknown command: {cmd}")
 
     def _get_guild(self, bot_id: str) -> Optional[discord.Guild]:
         try:
@@ -1009,67 +4094,70 @@ class AdminCLI:
                 self.guild_ids[self.next_guild_id] = guild.id
                 self.next_guild_id += 1
             bot_id = next(k for k, v in self.guild_ids.items() if v == guild.id)
-            state = get_guild_state(guild.id)
+            state = guild_states.get(guild.id)
             vc_status = "Connected" if guild.voice_client else "Disconnected"
+            if state is None:  # don't load idle guilds just to list them
+                _print(f"{guild.name} | BOT ID: {bot_id} | {vc_status} | Not loaded")
+                continue
             playback = "Playing" if state.is_playing else "Idle"
-            current = state.current_song['title'][:20] + '...' if state.current_song else 'None'
-            print(f"{guild.name} | BOT ID: {bot_id} | {vc_status} | {playback} | {current} | Queue: {state.queue.qsize()}")
+            current = state.current_song.title[:20] + '...' if state.current_song else 'None'
+            _print(f"{guild.name} | BOT ID: {bot_id} | {vc_status} | {playback} | {current} | Queue: {len(state.queue)}")
 
     async def cmd_channels(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         for channel in guild.channels:
             if channel.id not in self.channel_ids.values():
                 self.channel_ids[self.next_channel_id] = channel.id
                 self.next_channel_id += 1
             bot_id = next(k for k, v in self.channel_ids.items() if v == channel.id)
-            print(f"{channel.name} | BOT ID: {bot_id} | {type(channel).__name__}")
+            _print(f"{channel.name} | BOT ID: {bot_id} | {type(channel).__name__}")
 
     async def cmd_sendmsg(self, args):
         parts = args.split(maxsplit=2)
         if len(parts) < 3:
-            print("Usage: sendmsg <guild_bot_id> <channel_bot_id> <message>")
+            _print("Usage: sendmsg <guild_bot_id> <channel_bot_id> <message>")
             return
         guild = self._get_guild(parts[0])
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         channel = self._get_channel(guild, parts[1])
         if not channel or not isinstance(channel, discord.TextChannel):
-            print("Invalid channel")
+            _print("Invalid channel")
             return
         await channel.send(parts[2])
-        print("Message sent")
+        _print("Message sent")
 
     async def cmd_join(self, args):
         parts = args.split()
         if len(parts) < 2:
-            print("Usage: join <guild_bot_id> <channel_bot_id>")
+            _print("Usage: join <guild_bot_id> <channel_bot_id>")
             return
         guild = self._get_guild(parts[0])
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         channel = self._get_channel(guild, parts[1])
         if not channel or not isinstance(channel, discord.VoiceChannel):
-            print("Invalid voice channel")
+            _print("Invalid voice channel")
             return
         if guild.voice_client:
             await guild.voice_client.move_to(channel)
         else:
             await channel.connect()
-        print(f"Joined {channel.name}")
+        _print(f"Joined {channel.name}")
 
     async def cmd_stream(self, args):
         parts = args.split(maxsplit=1)
         if len(parts) < 2:
-            print("Usage: stream <guild_bot_id> <url>")
+            _print("Usage: stream <guild_bot_id> <url>")
             return
         guild = self._get_guild(parts[0])
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('stream').callback(ctx, query=parts[1])
@@ -1077,7 +4165,7 @@ class AdminCLI:
     async def cmd_clear(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('clear').callback(ctx)
@@ -1085,7 +4173,7 @@ class AdminCLI:
     async def cmd_leave(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('leave').callback(ctx)
@@ -1093,7 +4181,7 @@ class AdminCLI:
     async def cmd_pause(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('pause').callback(ctx)
@@ -1101,7 +4189,7 @@ class AdminCLI:
     async def cmd_resume(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('resume').callback(ctx)
@@ -1109,15 +4197,15 @@ class AdminCLI:
     async def cmd_queue(self, args):
         parts = args.split()
         if len(parts) < 2:
-            print("Usage: queue <guild_bot_id> <channel_bot_id>")
+            _print("Usage: queue <guild_bot_id> <channel_bot_id>")
             return
         guild = self._get_guild(parts[0])
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         channel = self._get_channel(guild, parts[1])
         if not channel or not isinstance(channel, discord.TextChannel):
-            print("Invalid text channel")
+            _print("Invalid text channel")
             return
         ctx = MockContext(guild, channel)
         await self.bot.get_command('queue').callback(ctx)
@@ -1125,7 +4213,7 @@ class AdminCLI:
     async def cmd_shuffle(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('shuffle').callback(ctx)
@@ -1133,7 +4221,7 @@ class AdminCLI:
     async def cmd_loop(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('loop').callback(ctx)
@@ -1141,11 +4229,11 @@ class AdminCLI:
     async def cmd_playlist_local(self, args):
         parts = args.split(maxsplit=1)
         if len(parts) < 2:
-            print("Usage: playlist_local <guild_bot_id> <filename>")
+            _print("Usage: playlist_local <guild_bot_id> <filename>")
             return
         guild = self._get_guild(parts[0])
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('playlist_local').callback(ctx, filename=parts[1])
@@ -1153,31 +4241,355 @@ class AdminCLI:
     async def cmd_usage(self, args):
         guild = self._get_guild(args)
         if not guild:
-            print("Invalid guild ID")
+            _print("Invalid guild ID")
             return
         ctx = MockContext(guild)
         await self.bot.get_command('usage').callback(ctx)
 
+    async def cmd_cache(self, args):
+        stats = downloader.cache.stats()
+        used_mb = stats['bytes'] / 1024 / 1024
+        _print(f"Track cache: {stats['entries']} tracks | {used_mb:.1f}/{TRACK_CACHE_MAX_MB} MB | {stats['hits']} hits")
+
+    async def cmd_traces(self, args):
+        summary = tracer.summary()
+        if not summary:
+            _print("No traced requests yet")
+            return
+        _print(f"{'Stage':<32}{'Count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for stage, (count, p50, p95, p99) in sorted(summary.items()):
+            _print(f"{stage:<32}{count:>7}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+        if tracer.dropped:
+            _print(f"({tracer.dropped} traces dropped by the exporter)")
+
+    async def cmd_memory(self, args):
+        limit = int(args) if args.strip().isdigit() else 20
+        rows = []
+        for state in list(guild_states.values()):
+            usage = guild_memory(state)
+            rows.append((sum(usage.values()), state, usage))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        now = time.time()
+        _print(f"{len(rows)} guilds loaded | {sum(row[0] for row in rows) / 1024:.1f} KiB | "
+              f"{len(last_join_channels)} remembered voice channels")
+        _print(f"{'Guild':<28}{'Queue':>7}{'History':>9}{'Total KiB':>11}{'Idle':>8}")
+        for total, state, usage in rows[:limit]:
+            guild = self.bot.get_guild(state.guild_id)
+            name = (guild.name if guild else str(state.guild_id))[:26]
+            idle = format_duration(max(1, now - state.last_activity))
+            _print(f"{name:<28}{len(state.queue):>7}{len(state.history):>9}{total / 1024:>11.1f}{idle:>8}")
+
+    async def cmd_library(self, args):
+        if not library.enabled:
+            _print("Local library disabled (set LIBRARY_DIRS)")
+            return
+        if args.strip() == 'rescan':
+            library.request_rescan()
+            _print("Library rescan requested")
+            return
+        if args.strip():
+            started = time.perf_counter()
+            matches = library.search(args, limit=10)
+            for entry in matches:
+                _print(f"{entry.display_title} ({format_duration(entry.duration)}) | {entry.path}")
+            _print(f"{len(matches)} matches in {(time.perf_counter() - started) * 1000:.2f} ms")
+            return
+        scan = library.last_scan
+        _print(f"Library: {len(library)} files in {', '.join(library.roots)}")
+        if scan:
+            _print(f"Last scan {int(time.time() - scan['at'])}s ago: {scan['probed']} probed, "
+                  f"{scan['removed']} removed in {scan['seconds']:.1f}s")
+
+    async def cmd_startup(self, args):
+        _print(startup.report())
+
     async def cmd_kill(self, args):
-        print("Shutting down bot...")
+        _print("Shutting down bot...")
         await self.bot.close()
         self.running = False
 
     async def cmd_exit(self, args):
         self.running = False
-        print("Exiting CLI. Bot continues running.")
+        _print("Exiting CLI. Bot continues running.")
+
+# ==================== Sharding ====================
+# Control pipe to the supervisor; set in shard processes only
+control_conn = None
+CACHE_LEASE_INTERVAL = 60
+
+
+def _recommended_shard_count() -> int:
+    """Ask Discord how many shards this bot should run."""
+    request = urllib.request.Request('https://discord.com/api/v10/gateway/bot',
+                                     headers={'Authorization': f'Bot {TOKEN}'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return int(json.load(response)['shards'])
+
+
+def _run_shard(conn) -> None:
+    """Entry point of a shard process (spawned, so module globals are rebuilt from its env)."""
+    global control_conn
+    control_conn = conn
+    bot.run(TOKEN)
+
+
+async def refresh_cache_leases() -> None:
+    """Keep this process's in-use tracks leased in the shared track cache."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, downloader.cache.lease, _paths_in_use(), CACHE_LEASE_INTERVAL * 3)
+        except Exception as e:
+            bot_logger.warning(f"Could not refresh track cache leases: {str(e)}")
+        await asyncio.sleep(CACHE_LEASE_INTERVAL)
+
+
+class ShardWorker:
+    """A child process running a group of shards, and the pipe to its admin CLI."""
+
+    def __init__(self, index: int, shard_ids: List[int], shard_count: int, processes: int):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.processes = processes
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.conn = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_at: Optional[float] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_request = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def _env(self) -> Dict[str, str]:
+        env = {
+            'FOLDA_SHARD_IDS': ','.join(map(str, self.shard_ids)),
+            'FOLDA_SHARD_COUNT': str(self.shard_count),
+            'FOLDA_SHARD_PROCESS': str(self.index),
+            # Per-process budget for the shared frame cache directory
+            'FRAME_CACHE_MAX_MB': str(FRAME_CACHE_MAX_MB // self.processes),
+            'TRACE_FILE': f"{os.path.splitext(TRACE_FILE)[0]}.shard{self.index}{os.path.splitext(TRACE_FILE)[1]}",
+        }
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(METRICS_PORT + 1 + self.index)
+        return env
+
+    def start(self) -> None:
+        context = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = context.Pipe()
+        env = self._env()
+        saved = {key: os.environ.get(key) for key in env}
+        # A spawned child starts from a copy of our environment
+        os.environ.update(env)
+        try:
+            self.process = context.Process(target=_run_shard, args=(child_conn,),
+                                           name=f"shard-{self.index}")
+            self.process.start()
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        child_conn.close()
+        self.conn = parent_conn
+        self.started_at = time.time()
+        self.restart_at = None
+        threading.Thread(target=self._read_replies, args=(parent_conn, asyncio.get_running_loop()),
+                         name=f"shard-{self.index}-replies", daemon=True).start()
+        cli_logger.info(f"Started shard process {self.index} (pid {self.process.pid}) for shards {self.shard_ids}")
+
+    def _read_replies(self, conn, loop: asyncio.AbstractEventLoop) -> None:
+        while True:
+            try:
+                request_id, output = conn.recv()
+            except (EOFError, OSError):
+                break
+            loop.call_soon_threadsafe(self._resolve, request_id, output)
+
+    def _resolve(self, request_id: int, output: str) -> None:
+        future = self._pending.get(request_id)
+        if future and not future.done():
+            future.set_result(output)
+
+    async def request(self, cmd_line: str, timeout: float = 60) -> str:
+        """Run an admin CLI command in this shard process and return what it printed."""
+        if not self.alive:
+            return "(shard process not running)\n"
+        self._next_request += 1
+        request_id = self._next_request
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            self.conn.send((request_id, cmd_line))
+            return await asyncio.wait_for(future, timeout)
+        except (OSError, asyncio.TimeoutError):
+            return "(no reply from shard process)\n"
+        finally:
+            self._pending.pop(request_id, None)
+
+
+class ShardSupervisor:
+    """Runs the bot as one child process per group of shards and restarts crashed ones.
+
+    Shard processes share the track, metadata and frame caches on disk. The
+    admin CLI runs here and forwards commands to the shard processes.
+    """
+    MAX_BACKOFF = 60
+    IDENTIFY_INTERVAL = 5  # Discord allows one shard login per 5 seconds
+
+    def __init__(self, shard_count: int, per_process: int):
+        groups = [list(range(first, min(first + per_process, shard_count)))
+                  for first in range(0, shard_count, per_process)]
+        self.workers = [ShardWorker(index, group, shard_count, len(groups)) for index, group in enumerate(groups)]
+        self.stopping = False
+
+    def worker_for_id(self, bot_id: int) -> Optional[ShardWorker]:
+        index = (bot_id - 1) // AdminCLI.ID_BLOCK
+        return self.workers[index] if 0 <= index < len(self.workers) else None
+
+    async def run(self) -> None:
+        cli = SupervisorCLI(self)
+        cli_task = asyncio.create_task(cli.run_async())
+        for worker in self.workers:
+            worker.start()
+            await asyncio.sleep(self.IDENTIFY_INTERVAL * len(worker.shard_ids))
+        while not self.stopping:
+            await asyncio.sleep(1)
+            self._check_workers()
+            # Every shard was shut down on purpose (e.g. 'kill' from its own CLI)
+            if all(not worker.alive and worker.process.exitcode == 0 for worker in self.workers):
+                break
+        cli_task.cancel()
+
+    def _check_workers(self) -> None:
+        now = time.time()
+        for worker in self.workers:
+            if worker.alive or worker.process.exitcode == 0:
+                continue
+            if worker.restart_at is None:
+                delay = min(self.MAX_BACKOFF, 5 * 2 ** min(worker.restarts, 4))
+                # A process that ran for a while before crashing starts over with a short backoff
+                if now - worker.started_at > 600:
+                    worker.restarts, delay = 0, 5
+                worker.restart_at = now + delay
+                cli_logger.error(f"Shard process {worker.index} exited with {worker.process.exitcode}; "
+                                 f"restarting in {delay}s")
+            elif now >= worker.restart_at:
+                worker.restarts += 1
+                worker.start()
+
+    async def stop(self) -> None:
+        self.stopping = True
+        await asyncio.gather(*(worker.request('kill', timeout=15) for worker in self.workers if worker.alive))
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.process.join, 15)
+            if worker.alive:
+                worker.process.terminate()
+
+
+class SupervisorCLI(AdminCLI):
+    """Admin CLI of the supervisor: guild commands go to the owning shard process, the rest to all."""
+
+    def __init__(self, supervisor: ShardSupervisor):
+        super().__init__(None)
+        self.supervisor = supervisor
+
+    async def process_command(self, cmd_line: str):
+        parts = cmd_line.split(maxsplit=1)
+        cmd = parts[0].lower()
+        args = parts[1] if len(parts) > 1 else ""
+        workers = self.supervisor.workers
+
+        if cmd == 'shards':
+            for worker in workers:
+                status = f"pid {worker.process.pid}, up {int(time.time() - worker.started_at)}s" \
+                    if worker.alive else f"down (exit {worker.process.exitcode})"
+                print(f"Process {worker.index} | shards {worker.shard_ids} | {status} | restarts: {worker.restarts}")
+        elif cmd == 'exit':
+            await self.cmd_exit(args)
+        elif cmd == 'kill':
+            print("Shutting down all shards...")
+            await self.supervisor.stop()
+            self.running = False
+        elif cmd == 'cache':
+            # One shared cache; any shard can report it
+            worker = next((worker for worker in workers if worker.alive), None)
+            print((await worker.request(cmd_line)).rstrip() if worker else "No shard process running")
+        elif args and args.split()[0].isdigit():
+            worker = self.supervisor.worker_for_id(int(args.split()[0]))
+            if worker is None:
+                print("Invalid guild ID")
+                return
+            print((await worker.request(cmd_line)).rstrip())
+        else:
+            replies = await asyncio.gather(*(worker.request(cmd_line) for worker in workers))
+            for worker, reply in zip(workers, replies):
+                print(f"-- process {worker.index} (shards {worker.shard_ids}) --")
+                print(reply.rstrip() or "(no output)")
+
+
+def run_supervisor() -> None:
+    shard_count = _recommended_shard_count() if SHARD_COUNT == 'auto' else int(SHARD_COUNT)
+    print(f"Folda Tunez - supervising {shard_count} shards, {SHARDS_PER_PROCESS} per process")
+    asyncio.run(ShardSupervisor(shard_count, max(1, SHARDS_PER_PROCESS)).run())
 
 # ==================== Bot Setup ====================
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, case_insensitive=True)
+if SHARD_IDS:
+    bot = commands.AutoShardedBot(command_prefix=BOT_PREFIX, intents=intents, case_insensitive=True,
+                                  shard_ids=SHARD_IDS, shard_count=int(os.getenv('FOLDA_SHARD_COUNT')))
+else:
+    bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, case_insensitive=True)
+
+startup.mark('module init')
+
+
+async def check_ffmpeg() -> None:
+    """Probe FFmpeg without blocking the event loop; shut down if it is missing."""
+    with startup.timed('ffmpeg probe'):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, '-version', stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            ok = await process.wait() == 0
+        except OSError:
+            ok = False
+    if not ok:
+        bot_logger.critical("FFmpeg not found!")
+        await bot.close()
+
+
+def _timed_job(job: str, func: Callable, *args) -> Callable[[], Any]:
+    def run():
+        with startup.timed(job):
+            return func(*args)
+    return run
+
+
+async def warm_caches() -> None:
+    """Start-up work that used to run at import time, now off the event loop."""
+    loop = asyncio.get_running_loop()
+    jobs = [
+        _timed_job('import yt_dlp', youtube_dl.load),
+        _timed_job('frame cache scan', frame_cache.scan),
+        _timed_job('metadata purge', downloader.metadata.purge_expired),
+    ]
+    results = await asyncio.gather(*(loop.run_in_executor(None, job) for job in jobs), return_exceptions=True)
+    for job, result in zip(('import yt_dlp', 'frame cache scan', 'metadata purge'), results):
+        if isinstance(result, Exception):
+            bot_logger.error(f"Start-up job '{job}' failed: {str(result)}")
+
 
 @bot.event
-async def on_ready():
-    bot_logger.info(f"Logged in as {bot.user}")
-    print(f"Folda Tunez v0.5.1 - Logged in as {bot.user}")
+async def setup_hook():
+    """Runs once, after login and before connecting to the gateway; reconnects skip it."""
+    startup.mark('login')
 
     # Remove default help command to avoid conflict
     bot.remove_command('help')
@@ -1185,17 +4597,33 @@ async def on_ready():
     # Add music cog
     await bot.add_cog(Music(bot))
 
-    # Start CLI in background task
-    cli = AdminCLI(bot)
-    bot.loop.create_task(cli.run_async())
+    # Start CLI in background task; shard processes take commands from the supervisor instead
+    cli = AdminCLI(bot, id_offset=SHARD_PROCESS * AdminCLI.ID_BLOCK)
+    if control_conn is not None:
+        cli.serve(control_conn)
+        bot.loop.create_task(refresh_cache_leases())
+    else:
+        bot.loop.create_task(cli.run_async())
+
+    # Spawn download worker processes now rather than on the first request
+    downloader.warm_up()
+    await metrics.start()
+    queue_store.start()
+
+    bot.loop.create_task(check_ffmpeg())
+    bot.loop.create_task(warm_caches())
+    bot.loop.create_task(reap_idle_guilds())
+    bot.loop.create_task(library.run())
+    startup.mark('setup_hook')
 
-    # Verify FFmpeg
-    import subprocess
-    try:
-        subprocess.run([FFMPEG_PATH, '-version'], capture_output=True, check=True)
-    except:
-        bot_logger.critical("FFmpeg not found!")
-        await bot.close()
+
+@bot.event
+async def on_ready():
+    bot_logger.info(f"Logged in as {bot.user}")
+    print(f"Folda Tunez v0.5.1 - Logged in as {bot.user}")
+    if not any(phase == 'gateway ready' for phase, _ in startup.phases):
+        startup.mark('gateway ready')
+        bot_logger.info(f"Startup breakdown:\n{startup.report()}")
 
 @bot.event
 async def on_voice_state_update(member, before, after):
@@ -1208,6 +4636,21 @@ async def on_voice_state_update(member, before, after):
             await state.stop_playback_loop()
         if member.guild.voice_client:
             await member.guild.voice_client.disconnect(force=True)
+    elif after.channel and state:
+        # Joined or moved channels: let an idle player pick up anything queued
+        state.wake_player()
+
+@bot.event
+async def on_guild_remove(guild):
+    downloader.scheduler.cancel_guild(guild.id)
+    queue_store.forget(guild.id)
+    state = guild_states.pop(guild.id, None)
+    if state:
+        state.cancel_prefetch()
+        await state.stop_playback_loop()
 
 if __name__ == "__main__":
-    bot.run('YOUR_TOKEN_HERE')
+    if SHARD_COUNT not in ('', '0') and not SHARD_IDS:
+        run_supervisor()
+    else:
+        bot.run(TOKEN)
@@ -0,0 +1,249 @@
+"""
+Local stand-ins for YouTube, Discord voice and command contexts.
+
+Everything here is plain Python so the bot can be driven offline: a fake
+YoutubeDL that serves generated audio files, a fake voice client that pulls
+AudioSource.read() on the real 20 ms cadence, and fake guild/channel/context
+objects with just enough surface for the Music cog and GuildState.
+"""
+
+import asyncio
+import itertools
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import discord
+
+FRAME_LENGTH = 0.02  # discord.py sends one 20 ms Opus packet per read()
+
+_ids = itertools.count(1000)
+
+
+def make_sample(path: str, seconds: float, ffmpeg: str = 'ffmpeg') -> str:
+    """Generate a sine-wave mp3 to stand in for downloaded tracks."""
+    if not os.path.exists(path):
+        subprocess.run(
+            [ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+             '-ac', '2', '-ar', '48000', '-c:a', 'libmp3lame', '-b:a', '128k', path],
+            check=True
+        )
+    return path
+
+
+# ==================== Fake yt-dlp ====================
+class FakeYoutubeDL:
+    """Serves https://bench.invalid/playlist/<n> and https://bench.invalid/track/<id> URLs.
+
+    Downloads copy `sample` into the configured outtmpl after `latency`
+    seconds, calling progress and post-processor hooks like the real thing.
+    """
+    sample: Optional[str] = None
+    latency = 0.05
+    duration = 2
+
+    _PLAYLIST = re.compile(r'https://bench\.invalid/playlist/(\d+)')
+    _TRACK = re.compile(r'https://bench\.invalid/track/(\w+)')
+
+    def __init__(self, opts: Optional[Dict[str, Any]] = None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _track_info(self, track_id: str) -> Dict[str, Any]:
+        return {
+            'id': track_id,
+            'title': f'Benchmark track {track_id}',
+            'duration': self.duration,
+            'webpage_url': f'https://bench.invalid/track/{track_id}',
+            'extractor_key': 'Bench',
+            'ext': 'mp3',
+            'acodec': 'mp3',
+            'vcodec': 'none',
+        }
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True) -> Optional[Dict[str, Any]]:
+        match = self._PLAYLIST.fullmatch(url)
+        if match:
+            count = int(match.group(1))
+            return {
+                'id': f'playlist{count}',
+                'title': f'Benchmark playlist ({count})',
+                '_type': 'playlist',
+                'entries': ({'id': f'p{i}', 'title': f'Benchmark track p{i}', 'duration': self.duration,
+                             'webpage_url': f'https://bench.invalid/track/p{i}'} for i in range(count)),
+            }
+        match = self._TRACK.fullmatch(url)
+        if not match:
+            return None
+        info = self._track_info(match.group(1))
+        if download:
+            self.process_info(info)
+        return info
+
+    def process_info(self, info: Dict[str, Any]) -> None:
+        for hook in self.opts.get('progress_hooks', []):
+            hook({'status': 'downloading', 'info_dict': info})
+        time.sleep(self.latency)
+        target = self.prepare_filename(info)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if self.sample and not os.path.exists(target):
+            shutil.copyfile(self.sample, target)
+        for hook in self.opts.get('progress_hooks', []):
+            hook({'status': 'finished', 'info_dict': info, 'filename': target})
+        for hook in self.opts.get('postprocessor_hooks', []):
+            hook({'status': 'started', 'postprocessor': 'FakeExtractAudio', 'info_dict': info})
+            hook({'status': 'finished', 'postprocessor': 'FakeExtractAudio', 'info_dict': info})
+
+    def prepare_filename(self, info: Dict[str, Any]) -> str:
+        return self.opts.get('outtmpl', '%(id)s.%(ext)s') % info
+
+    @staticmethod
+    def sanitize_info(info: Dict[str, Any]) -> Dict[str, Any]:
+        return info
+
+
+# ==================== Fake Discord ====================
+class FakeMessage:
+    def __init__(self, channel: 'FakeChannel', content: str):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content: Optional[str] = None, **kwargs) -> None:
+        if content is not None:
+            self.content = content
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = next(_ids)
+        self.name = f'bench-{self.id}'
+        self.sent: List[str] = []
+
+    async def send(self, content: str = '', **kwargs) -> FakeMessage:
+        self.sent.append(content)
+        return FakeMessage(self, content)
+
+
+class FakeVoiceClient:
+    """Consumes an AudioSource on a thread at real-time speed, like discord.py's AudioPlayer.
+
+    `tracks` records (first packet, last packet, packet count) per played source.
+    """
+
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+        self.tracks: List[List[float]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._ended = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and not self._ended.is_set() and self._resumed.is_set()
+
+    def is_paused(self) -> bool:
+        return self._thread is not None and not self._ended.is_set() and not self._resumed.is_set()
+
+    def play(self, source: discord.AudioSource, *, after=None) -> None:
+        if self._thread is not None and not self._ended.is_set():
+            raise discord.ClientException('Already playing audio.')
+        self._stopped.clear()
+        self._ended.clear()
+        self._resumed.set()
+        self._thread = threading.Thread(target=self._run, args=(source, after), daemon=True)
+        self._thread.start()
+
+    def _run(self, source: discord.AudioSource, after) -> None:
+        record = None
+        error = None
+        next_at = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                self._resumed.wait()
+                data = source.read()
+                if not data:
+                    break
+                now = time.perf_counter()
+                if record is None:
+                    record = [now, now, 0]
+                    self.tracks.append(record)
+                record[1] = now
+                record[2] += 1
+                next_at += FRAME_LENGTH
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            # Like discord.py, the client stops reporting is_playing() before `after` runs
+            self._ended.set()
+            source.cleanup()
+            if after:
+                after(error)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._resumed.set()
+
+    def pause(self) -> None:
+        self._resumed.clear()
+
+    def resume(self) -> None:
+        self._resumed.set()
+
+    async def disconnect(self, force: bool = False) -> None:
+        self.stop()
+
+
+class FakeGuild:
+    def __init__(self):
+        self.id = next(_ids)
+        self.name = f'Benchmark guild {self.id}'
+        self.text_channel = FakeChannel()
+        self.voice_channel = FakeChannel()
+        self.voice_client = FakeVoiceClient(self.voice_channel)
+
+
+class FakeAuthor:
+    def __init__(self, channel: FakeChannel):
+        self.display_name = 'Benchmark'
+        self.voice = type('FakeVoiceState', (), {'channel': channel})()
+
+
+class FakeContext:
+    """Just enough of commands.Context for the Music cog and GuildState."""
+
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = FakeAuthor(guild.voice_channel)
+        self.message = type('FakeMessageRef', (), {'guild': guild, 'author': self.author, 'channel': self.channel})()
+
+    @property
+    def voice_client(self) -> FakeVoiceClient:
+        return self.guild.voice_client
+
+    async def send(self, content: str = '', **kwargs) -> FakeMessage:
+        return await self.channel.send(content, **kwargs)
+
+
+async def wait_until(predicate, timeout: float, interval: float = 0.05) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
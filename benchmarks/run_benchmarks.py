@@ -0,0 +1,279 @@
+"""
+Offline benchmarks for Folda Tunez.
+
+Drives the Music cog, GuildState and Downloader against the stand-ins in
+fakes.py, so no Discord token or network access is needed (ffmpeg is, for
+the playback scenarios). Reports:
+
+    ingest    playlist enqueue and download throughput
+    queue     per-operation latency on a large queue
+    gap       silence between consecutive tracks, cold (ffmpeg) and warm (frame cache)
+    cpu       CPU use per concurrently playing guild
+
+Usage:
+    python benchmarks/run_benchmarks.py [--only ingest,queue] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ROOT, HERE]
+
+from fakes import FRAME_LENGTH, FakeContext, FakeGuild, FakeYoutubeDL, make_sample, wait_until
+
+SCENARIOS = ('ingest', 'queue', 'gap', 'cpu')
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def summarize(samples: List[float], scale: float = 1000.0) -> Dict[str, float]:
+    return {
+        'mean': scale * sum(samples) / max(1, len(samples)),
+        'p50': scale * percentile(samples, 0.50),
+        'p95': scale * percentile(samples, 0.95),
+        'p99': scale * percentile(samples, 0.99),
+        'max': scale * max(samples, default=0.0),
+    }
+
+
+def make_tracks(ftb, directory: str, sample: str, count: int, seconds: float) -> List[Any]:
+    """Distinct copies of the sample, so neither the track nor the frame cache dedupes them."""
+    os.makedirs(directory, exist_ok=True)
+    songs = []
+    for i in range(count):
+        path = os.path.join(directory, f'{i}.mp3')
+        shutil.copyfile(sample, path)
+        songs.append(ftb.Track(f'Track {i}', path, duration=int(seconds), requester='Benchmark', acodec='mp3'))
+    return songs
+
+
+async def play_through(ftb, ctx: FakeContext, songs: List[Any], seconds: float) -> None:
+    state = ftb.get_guild_state(ctx.guild.id)
+    played = len(ctx.voice_client.tracks) + len(songs)
+    state.queue.extend(songs)
+    await state.start_playback_loop(ctx)
+    timeout = len(songs) * (seconds + 10)
+    finished = await wait_until(lambda: len(ctx.voice_client.tracks) >= played
+                                and not state.is_playing and not ctx.voice_client.is_playing(), timeout)
+    await state.stop_playback_loop()
+    if not finished:
+        started = len(ctx.voice_client.tracks) - played + len(songs)
+        raise RuntimeError(f"Only {started} of {len(songs)} tracks played within {timeout:.0f}s")
+
+
+async def bench_ingest(ftb, cog, args) -> Dict[str, Any]:
+    ctx = FakeContext(FakeGuild())
+    state = ftb.get_guild_state(ctx.guild.id)
+    state.is_playing = True  # measure ingest only; keep the player out of it
+    url = f'https://bench.invalid/playlist/{args.tracks}'
+
+    results = {}
+    for label in ('cold', 'warm'):  # warm: playlist metadata served from the metadata cache
+        state.queue.clear()
+        start = time.perf_counter()
+        await cog._handle_playlist(ctx, url)
+        elapsed = time.perf_counter() - start
+        state.cancel_prefetch()
+        results[f'enqueue_{label}_tracks_per_s'] = len(state.queue) / elapsed
+
+    songs = state.queue.slice(0, args.downloads)
+    start = time.perf_counter()
+    resolved = await asyncio.gather(*(
+        ftb.downloader.download_single(song.webpage_url, guild_id=ctx.guild.id, interactive=False)
+        for song in songs
+    ))
+    elapsed = time.perf_counter() - start
+    results['downloads'] = sum(1 for song in resolved if song)
+    results['download_tracks_per_s'] = results['downloads'] / elapsed
+    results['download_latency_s'] = FakeYoutubeDL.latency
+    state.queue.clear()
+    return results
+
+
+async def bench_queue(ftb, cog, args) -> Dict[str, Any]:
+    ctx = FakeContext(FakeGuild())
+    state = ftb.get_guild_state(ctx.guild.id)
+    state.is_playing = True  # commands must not start the player
+    song = lambda i: ftb.Track(f'Track {i}', f'/bench/{i}.mp3', duration=180, requester='Benchmark')
+    state.queue.extend([song(i) for i in range(args.queue_size)])
+    size = args.queue_size
+
+    async def remove():
+        await ftb.Music.remove.callback(cog, ctx, random.randint(1, size))
+        state.queue.append(song(-1))
+
+    async def playnext():
+        await ftb.Music.playnext.callback(cog, ctx, args=str(random.randint(1, size)))
+
+    async def queue_page():
+        view = ftb.QueueView(state, ctx)
+        view.page = random.randrange(view.pages)
+        view.render()
+        view.stop()
+
+    async def queue_command():
+        await ftb.Music.queue.callback(cog, ctx)
+
+    async def shuffle():
+        await ftb.Music.shuffle.callback(cog, ctx)
+
+    async def append_popleft():
+        state.queue.append(song(-1))
+        state.queue.popleft()
+
+    operations = {
+        'append+popleft': append_popleft,
+        '!remove <random>': remove,
+        '!playnext <random>': playnext,
+        'queue page render': queue_page,
+        '!queue': queue_command,
+        '!shuffle': shuffle,
+    }
+    results = {'queue_size': size}
+    for name, operation in operations.items():
+        samples = []
+        for _ in range(args.repeat if name != '!shuffle' else max(1, args.repeat // 20)):
+            start = time.perf_counter()
+            await operation()
+            samples.append(time.perf_counter() - start)
+        results[name] = summarize(samples, scale=1e6)  # microseconds
+    state.queue.clear()
+    return results
+
+
+async def bench_gap(ftb, cog, args, sample: str) -> Dict[str, Any]:
+    ctx = FakeContext(FakeGuild())
+    songs = make_tracks(ftb, os.path.join('gap', str(ctx.guild.id)), sample, args.gap_tracks, args.track_seconds)
+
+    results = {}
+    for label in ('cold', 'warm'):  # warm: the second pass replays from the Opus frame cache
+        first = len(ctx.voice_client.tracks)
+        await play_through(ftb, ctx, [ftb.Track.unpack(song.pack()) for song in songs], args.track_seconds)
+        tracks = ctx.voice_client.tracks[first:]
+        assert tracks, f"no tracks played in the {label} pass"
+        gaps = [max(0.0, nxt[0] - prev[1] - FRAME_LENGTH) for prev, nxt in zip(tracks, tracks[1:])]
+        results[label] = {'tracks': len(tracks), **summarize(gaps)}  # milliseconds
+        await asyncio.sleep(0.5)  # let frame cache commits land
+    return results
+
+
+async def bench_cpu(ftb, cog, args, sample: str) -> Dict[str, Any]:
+    results = {}
+    for guilds in args.guilds:
+        contexts = [FakeContext(FakeGuild()) for _ in range(guilds)]
+        playlists = [make_tracks(ftb, os.path.join('cpu', str(ctx.guild.id)), sample, args.cpu_tracks,
+                                 args.track_seconds) for ctx in contexts]
+        before, wall = os.times(), time.perf_counter()
+        await asyncio.gather(*(play_through(ftb, ctx, songs, args.track_seconds)
+                               for ctx, songs in zip(contexts, playlists)))
+        after, wall = os.times(), time.perf_counter() - wall
+        # children_* covers the ffmpeg processes, which have all exited by now
+        cpu = sum(after[i] - before[i] for i in range(4))
+        results[str(guilds)] = {
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'cpu_percent_per_guild': 100 * cpu / wall / guilds,
+        }
+    return results
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    for scenario, data in results.items():
+        print(f"\n== {scenario} ==")
+        for key, value in data.items():
+            if isinstance(value, dict):
+                cells = '  '.join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items())
+                print(f"  {key:<22} {cells}")
+            else:
+                print(f"  {key:<22} {value:.2f}" if isinstance(value, float) else f"  {key:<22} {value}")
+    print("\n(queue latencies in microseconds, gaps in milliseconds)")
+
+
+async def run(ftb, args, sample: str) -> Dict[str, Any]:
+    ftb.bot.loop = asyncio.get_running_loop()  # normally set by bot.start()
+    cog = ftb.Music(ftb.bot)
+    results = {}
+    if 'ingest' in args.only:
+        results['ingest'] = await bench_ingest(ftb, cog, args)
+    if 'queue' in args.only:
+        results['queue'] = await bench_queue(ftb, cog, args)
+    if 'gap' in args.only:
+        results['gap'] = await bench_gap(ftb, cog, args, sample)
+    if 'cpu' in args.only:
+        results['cpu'] = await bench_cpu(ftb, cog, args, sample)
+    ftb.downloader.executor.shutdown(wait=False)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default=','.join(SCENARIOS), help='comma-separated scenarios to run')
+    parser.add_argument('--tracks', type=int, default=1000, help='playlist size for ingest')
+    parser.add_argument('--downloads', type=int, default=200, help='tracks downloaded in the ingest run')
+    parser.add_argument('--download-latency', type=float, default=0.05, help='fake download time per track (s)')
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=500, help='samples per queue operation')
+    parser.add_argument('--gap-tracks', type=int, default=6)
+    parser.add_argument('--track-seconds', type=float, default=3.0)
+    parser.add_argument('--guilds', default='1,4,8', help='concurrent guild counts for the cpu run')
+    parser.add_argument('--cpu-tracks', type=int, default=2, help='tracks per guild in the cpu run')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+    args.only = [name.strip() for name in args.only.split(',') if name.strip()]
+    args.guilds = [int(n) for n in args.guilds.split(',')]
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # Caches, logs and generated audio all go to a scratch directory
+    workdir = tempfile.mkdtemp(prefix='foldatunez-bench-')
+    os.chdir(workdir)
+    os.environ.update({
+        'DISCORD_BOT_TOKEN': os.environ.get('DISCORD_BOT_TOKEN', 'benchmark'),
+        'DOWNLOAD_BACKEND': 'thread',  # the fake YoutubeDL only exists in this process
+        'TRACK_CACHE_DIR': os.path.join(workdir, 'downloads'),
+        'CACHE_DIR': os.path.join(workdir, 'cache'),
+        'MAX_PLAYLIST_ITEMS': str(max(args.tracks, 1)),
+        'METRICS_PORT': '0',
+        'TRACE_EXPORT': 'off',
+    })
+
+    import FoldaTunezBot as ftb
+    for logger in (ftb.bot_logger, ftb.cli_logger):
+        logger.setLevel(logging.WARNING)
+    ftb.youtube_dl.YoutubeDL = FakeYoutubeDL
+
+    sample = None
+    if {'ingest', 'gap', 'cpu'} & set(args.only):
+        sample = make_sample(os.path.join(workdir, 'sample.mp3'), args.track_seconds, ftb.FFMPEG_PATH)
+    FakeYoutubeDL.sample = sample
+    FakeYoutubeDL.latency = args.download_latency
+
+    try:
+        results = asyncio.run(run(ftb, args, sample))
+    finally:
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
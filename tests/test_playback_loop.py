@@ -0,0 +1,117 @@
+"""
+The playback loop must sleep while a guild is idle and recover from
+unexpected play() failures, driven offline through benchmarks/fakes.py.
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('discord')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+import discord
+from fakes import FakeContext, FakeGuild, wait_until
+
+
+@pytest.fixture(scope='module')
+def ftb(tmp_path_factory):
+    # Caches and logs go to a scratch directory, as in the benchmarks
+    workdir = tmp_path_factory.mktemp('foldatunez')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.update({
+        'DISCORD_BOT_TOKEN': os.environ.get('DISCORD_BOT_TOKEN', 'test'),
+        'TRACK_CACHE_DIR': str(workdir / 'downloads'),
+        'CACHE_DIR': str(workdir / 'cache'),
+        'PERSIST_QUEUES': '0',
+        'FRAME_CACHE_MAX_MB': '0',
+        'METRICS_PORT': '0',
+        'TRACE_EXPORT': 'off',
+    })
+    import FoldaTunezBot
+    yield FoldaTunezBot
+    os.chdir(cwd)
+
+
+class CountingEvent(asyncio.Event):
+    """asyncio.Event that counts how often a waiter was woken."""
+    wakeups = 0
+
+    async def wait(self):
+        await super().wait()
+        self.wakeups += 1
+        return True
+
+
+class SilentSource(discord.AudioSource):
+    """Stands in for ffmpeg: a track that ends immediately."""
+
+    def __init__(self, *args, **kwargs):
+        self.on_start = None
+
+    def read(self) -> bytes:
+        return b''
+
+
+def make_tracks(ftb, directory, count):
+    songs = []
+    for i in range(count):
+        path = os.path.join(directory, f'{i}.mp3')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1024)
+        songs.append(ftb.Track(f'Track {i}', path, requester='Test'))
+    return songs
+
+
+def test_idle_guild_has_no_wakeups(ftb, tmp_path, monkeypatch):
+    monkeypatch.setattr(ftb, 'TrackedFFmpegOpusAudio', SilentSource)
+
+    async def run():
+        ftb.bot.loop = asyncio.get_running_loop()
+        ctx = FakeContext(FakeGuild())
+        state = ftb.get_guild_state(ctx.guild.id)
+        state.wake = CountingEvent()
+        state.queue.extend(make_tracks(ftb, str(tmp_path), 2))
+        await state.start_playback_loop(ctx)
+        assert await wait_until(lambda: not state.queue and not state.is_playing and not state.playback_active, 5)
+        await asyncio.sleep(0.1)  # let the last after-callback land
+
+        state.wake.wakeups = 0
+        await asyncio.sleep(1.0)
+        assert state.wake.wakeups == 0
+        assert not state.playback_task.done()
+        await state.stop_playback_loop()
+
+    asyncio.run(run())
+
+
+def test_play_failure_moves_on_to_next_track(ftb, tmp_path, monkeypatch):
+    monkeypatch.setattr(ftb, 'TrackedFFmpegOpusAudio', SilentSource)
+    monkeypatch.setattr(ftb.GuildState, 'RETRY_DELAY', 0.05)
+
+    async def run():
+        ftb.bot.loop = asyncio.get_running_loop()
+        ctx = FakeContext(FakeGuild())
+        state = ftb.get_guild_state(ctx.guild.id)
+        played = []
+        play = ctx.voice_client.play
+
+        def flaky_play(source, *, after=None):
+            played.append(state.current_song.title)
+            if len(played) == 1:
+                raise RuntimeError('voice connection dropped')
+            play(source, after=after)
+
+        ctx.voice_client.play = flaky_play
+        state.queue.extend(make_tracks(ftb, str(tmp_path), 2))
+        await state.start_playback_loop(ctx)
+        assert await wait_until(lambda: len(played) == 2, 5), played
+        assert played == ['Track 0', 'Track 1']
+        await state.stop_playback_loop()
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+"""
+Track.pack()/load() round trips, as used by queue persistence.
+"""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('discord')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='module')
+def ftb(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('foldatunez')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.update({
+        'DISCORD_BOT_TOKEN': os.environ.get('DISCORD_BOT_TOKEN', 'test'),
+        'CACHE_DIR': str(workdir / 'cache'),
+        'METRICS_PORT': '0',
+        'TRACE_EXPORT': 'off',
+    })
+    import FoldaTunezBot
+    yield FoldaTunezBot
+    os.chdir(cwd)
+
+
+def fields(track):
+    return [getattr(track, name) for name in track.FIELDS]
+
+
+@pytest.mark.parametrize('args, kwargs', [
+    (('', ''), {}),
+    (('',), {'url': ''}),
+    (('Song', '/music/song.mp3'), {}),
+    (('Song', 'https://example.com/v'), {'webpage_url': 'https://example.com/v', 'duration': 181,
+                                         'requester': 'Alice', 'acodec': 'opus', 'status': 'pending',
+                                         'resume_at': 12.5, 'size': 4096}),
+    (('', ''), {'size': 1}),
+])
+def test_pack_round_trip(ftb, args, kwargs):
+    track = ftb.Track(*args, **kwargs)
+    packed = track.pack()
+    assert fields(ftb.Track.load(packed)) == fields(track)
+
+
+def test_pack_drops_trailing_defaults(ftb):
+    assert ftb.Track('Song', '/music/song.mp3').pack() == ['Song', '/music/song.mp3']
+    assert ftb.Track('', '').pack() == ['', '']
+
+
+def test_load_accepts_old_dict_snapshots(ftb):
+    track = ftb.Track.load({'title': 'Song', 'url': '/music/song.mp3', 'duration': 60, 'unknown': 1})
+    assert (track.title, track.url, track.duration) == ('Song', '/music/song.mp3', 60)